@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+
+import os
+import sys
+import random
+from argparse import ArgumentParser
+from timeit import default_timer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import export2graphlan as e2g
+
+
+def read_params():
+    """
+    Parse the input parameters.
+    Return the parsed arguments.
+    """
+    parser = ArgumentParser(description="Measure the wall time of the automatic biomarkers selection (used when no "
+                                        "LEfSe output is given) on synthetic taxonomies of increasing size")
+    parser.add_argument('-s', '--sizes',
+        default='1000,10000,100000,500000',
+        type=str,
+        required=False,
+        help="Comma-separated list of the numbers of features to generate. Default is 1000,10000,100000,500000")
+    parser.add_argument('--most_abundant',
+        default=100,
+        type=int,
+        required=False,
+        help="Number of most abundant features to select. Default is 100")
+    parser.add_argument('--least_biomarkers',
+        default=3,
+        type=int,
+        required=False,
+        help="Minimum number of distinct branches to highlight. Default is 3")
+    parser.add_argument('--seed',
+        default=0,
+        type=int,
+        required=False,
+        help="Seed of the random generator. Default is 0")
+
+    return parser.parse_args()
+
+
+def synthetic_abundances(n, seed=0, depth=7, branching=8):
+    """
+    Generate ``n`` random taxonomies, '|'-separated and of varying depth, with a random abundance each.
+    Return the dict of abundances.
+    """
+    rnd = random.Random(seed)
+    abundances = {}
+
+    while len(abundances) < n:
+        lvls = rnd.randint(2, depth)
+        taxa = '|'.join(['l' + str(l) + '_' + str(rnd.randint(0, branching ** (l + 1))) for l in range(lvls)])
+        abundances[taxa] = rnd.expovariate(1.)
+
+    return abundances
+
+
+def sort_most_abundant(abundances, xxx):
+    """
+    Previous selection of get_most_abundant(), sorting all the features.
+    Return the first ``xxx`` most abundant.
+    """
+    abundant = []
+
+    for a in abundances:
+        if a.count('|') > 0:
+            abundant.append((float(abundances[a]), a.replace('|', '.')))
+        elif a.count('.') > 0:
+            abundant.append((float(abundances[a]), a))
+
+    abundant.sort(reverse=True)
+    return abundant[:xxx]
+
+
+def timed(func, *args):
+    """
+    Call ``func`` with ``args``.
+    Return the wall time, in seconds, and the result.
+    """
+    start = default_timer()
+    res = func(*args)
+    return default_timer() - start, res
+
+
+def main():
+    args = read_params()
+
+    print '\t'.join(['features', 'sort (s)', 'heap (s)', 'speedup', 'get_biomarkes (s)', 'biomarkers'])
+
+    for n in [int(s) for s in args.sizes.split(',')]:
+        abundances = synthetic_abundances(n, args.seed)
+        t_sort, by_sort = timed(sort_most_abundant, abundances, args.most_abundant)
+        t_heap, by_heap = timed(e2g.get_most_abundant, abundances, args.most_abundant)
+
+        if by_sort != by_heap:
+            raise Exception('[main()] The heap selection differs from the full sort with ' + str(n) + ' features')
+
+        t_bk, biomarkers = timed(e2g.get_biomarkes, by_heap, args.least_biomarkers)
+        print '\t'.join([str(n), '{0:.4f}'.format(t_sort), '{0:.4f}'.format(t_heap),
+                         '{0:.1f}x'.format(t_sort / t_heap if t_heap else 0.), '{0:.4f}'.format(t_bk),
+                         str(len(biomarkers))])
+
+
+if __name__ == '__main__':
+    main()
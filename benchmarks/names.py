@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+
+import os
+import sys
+import random
+from argparse import ArgumentParser
+from timeit import default_timer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import export2graphlan as e2g
+
+
+def read_params():
+    """
+    Parse the input parameters.
+    Return the parsed arguments.
+    """
+    parser = ArgumentParser(description="Compare the wall time of the taxonomy names normalization and of the display "
+                                        "names of NameNormalizer with the chains of replace() calls they substituted")
+    parser.add_argument('-n', '--names',
+        default=1000000,
+        type=int,
+        required=False,
+        help="Number of names to normalize. Default is 1000000")
+    parser.add_argument('--seed',
+        default=0,
+        type=int,
+        required=False,
+        help="Seed of the random generator. Default is 0")
+
+    return parser.parse_args()
+
+
+def replace_chain(t):
+    """
+    Previous normalization of the taxonomy names, one replace() call for each character.
+    """
+    return t.replace('|', '.').strip().replace('u\'', '').replace(' ', '').replace('\'', '').replace('[', '').replace(']', '').replace('{', '').replace('}', '').replace('(', '').replace(')', '').replace('=', '_').replace('-', '_')
+
+
+def replace_chain_level(s):
+    """
+    Previous normalization of the single levels of the BIOM taxonomies.
+    """
+    return s.strip().replace('u\'', '').replace(' ', '').replace('\'', '').replace('[', '').replace(']', '').replace('{', '').replace('}', '').replace('(', '').replace(')', '').replace('=', '_').replace('-', '_')
+
+
+def display_name(name):
+    """
+    Previous computation of the display names.
+    """
+    return e2g.pre_taxa.sub('', name).replace('_', ' ')
+
+
+def generate_names(n, rnd=random):
+    """
+    Return ``n`` distinct MetaPhlAn-like names, some of them with the characters removed by the normalization.
+    """
+    decorations = ['', '', '', '[{0}]', '{0}-like', 'u\'{0}\'', '{0} (class)', '{0}=1']
+    names = []
+
+    for i in range(n):
+        levels = ['k__Bacteria', 'p__P' + str(rnd.randint(0, 30)), 'c__C' + str(rnd.randint(0, 100)),
+                  'o__O' + str(rnd.randint(0, 300)), 'f__F' + str(rnd.randint(0, 1000)), 'g__G' + str(i)]
+        levels[-1] = rnd.choice(decorations).format(levels[-1]) or levels[-1]
+        names.append('|'.join(levels))
+
+    return names
+
+
+def timed(func, names):
+    """
+    Return the wall time of ``func`` applied to all the ``names``, and the results.
+    """
+    start = default_timer()
+    res = [func(t) for t in names]
+    return default_timer() - start, res
+
+
+def main():
+    args = read_params()
+    taxonomies = generate_names(args.names, random.Random(args.seed))
+    levels = [l for t in taxonomies[:args.names / 6 + 1] for l in t.split('|')][:args.names]  # repeated levels
+    runs = [('taxonomies', taxonomies, replace_chain, e2g.NameNormalizer().taxonomy),
+            ('levels', levels, replace_chain_level, e2g.NameNormalizer().clean),
+            ('display names', levels, display_name, e2g.NameNormalizer().label)]
+
+    print '\t'.join(['names', 'previous (s)', 'NameNormalizer (s)', 'speedup'])
+
+    for label, names, previous, normalizer in runs:
+        t_prev, by_prev = timed(previous, names)
+        del by_prev[:]  # do not slow down the next run with the memory of this one
+        t_norm, by_norm = timed(normalizer, names)
+
+        if [previous(t) for t in names] != by_norm:
+            raise Exception('[main()] NameNormalizer differs from the previous code on the ' + label)
+
+        print '\t'.join([label, '{0:.3f}'.format(t_prev), '{0:.3f}'.format(t_norm),
+                         '{0:.1f}x'.format(t_prev / t_norm if t_norm else 0.)])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+
+import os
+import sys
+import subprocess
+from argparse import ArgumentParser
+from shutil import rmtree
+from tempfile import mkdtemp
+from timeit import default_timer
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EXAMPLE = os.path.join(ROOT, 'examples', 'hmp_aerobiosis')
+
+
+def read_params():
+    """
+    Parse the input parameters.
+    Return the parsed arguments.
+    """
+    parser = ArgumentParser(description="Measure the wall time of export2graphlan.py runs that use only the LEfSe "
+                                        "output against full runs with the LEfSe input matrix")
+    parser.add_argument('-n', '--repeats',
+        default=10,
+        type=int,
+        required=False,
+        help="Number of runs for each configuration. Default is 10")
+
+    return parser.parse_args()
+
+
+def time_runs(cmd, repeats):
+    """
+    Run ``cmd`` ``repeats`` times.
+    Return the list of wall times, in seconds.
+    """
+    times = []
+
+    for _ in range(repeats):
+        start = default_timer()
+        subprocess.check_call(cmd, stdout=open(os.devnull, 'w'))
+        times.append(default_timer() - start)
+
+    return times
+
+
+def main():
+    args = read_params()
+    out_dir = mkdtemp()
+    script = [sys.executable, os.path.join(ROOT, 'export2graphlan.py'),
+              '-t', os.path.join(out_dir, 'tree.txt'), '-a', os.path.join(out_dir, 'annot.txt')]
+    runs = [('lefse_output only', script + ['-o', os.path.join(EXAMPLE, 'lefse_output.txt')]),
+            ('full', script + ['-i', os.path.join(EXAMPLE, 'lefse_input.txt'),
+                               '-o', os.path.join(EXAMPLE, 'lefse_output.txt'),
+                               '--fname_row', '0', '--skip_rows', '1,2', '--ftop', '200'])]
+
+    try:
+        print '\t'.join(['run', 'min (s)', 'median (s)', 'max (s)'])
+
+        for name, cmd in runs:
+            times = sorted(time_runs(cmd, args.repeats))
+            print '\t'.join([name] + ['{0:.3f}'.format(t) for t in [times[0], times[len(times) / 2], times[-1]]])
+    finally:
+        rmtree(out_dir)
+
+
+if __name__ == '__main__':
+    main()
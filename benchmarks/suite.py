@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+
+
+import os
+import sys
+import json
+import random
+import platform
+from argparse import ArgumentParser
+from shutil import rmtree
+from tempfile import mkdtemp
+from timeit import default_timer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import export2graphlan as e2g
+
+
+LEVELS = ['k', 'p', 'c', 'o', 'f', 'g', 's', 't']
+CLASSES = ['Class_A', 'Class_B', 'Class_C']
+CASES = ['tsv', 'tsv_no_output', 'biom']
+
+
+def read_params():
+    """
+    Parse the input parameters.
+    Return the parsed arguments.
+    """
+    parser = ArgumentParser(description="Benchmark suite of export2graphlan.py: generate synthetic LEfSe inputs, LEfSe "
+                                        "outputs and BIOM tables of increasing size, time each stage of the conversion "
+                                        "and the full conversion, save the results, and compare them with a baseline")
+    parser.add_argument('-s', '--sizes',
+        default='1000,10000,100000',
+        type=str,
+        required=False,
+        help="Comma-separated list of the numbers of features to generate. Default is 1000,10000,100000")
+    parser.add_argument('--cases',
+        default=','.join(CASES),
+        type=str,
+        required=False,
+        help="Comma-separated list of the cases to run: tsv (tab-separated lefse_input with --internal_levels and "
+             "lefse_output), tsv_no_output (tab-separated lefse_input only), biom (BIOM table with --internal_levels). "
+             "Default is " + ','.join(CASES))
+    parser.add_argument('--samples',
+        default=20,
+        type=int,
+        required=False,
+        help="Number of samples of the generated inputs. Default is 20")
+    parser.add_argument('--depth',
+        default=7,
+        type=int,
+        required=False,
+        help="Maximum number of taxonomic levels of the generated features (at most 8). Default is 7")
+    parser.add_argument('--branching',
+        default=6,
+        type=int,
+        required=False,
+        help="Number of children of each internal clade in the generated taxonomy. Default is 6")
+    parser.add_argument('--dup_rate',
+        default=0.1,
+        type=float,
+        required=False,
+        help="Fraction of the OTUs of the BIOM table that share the taxonomy of another OTU, and are merged while "
+             "parsing. Default is 0.1")
+    parser.add_argument('--biomarker_rate',
+        default=0.1,
+        type=float,
+        required=False,
+        help="Fraction of the clades of the LEfSe output that are biomarkers. Default is 0.1")
+    parser.add_argument('--background_clades',
+        default=5,
+        type=int,
+        required=False,
+        help="Number of clades given to --background_clades. Default is 5")
+    parser.add_argument('-n', '--repeats',
+        default=3,
+        type=int,
+        required=False,
+        help="Number of runs of each case, the minimum time of each stage is reported. Default is 3")
+    parser.add_argument('--seed',
+        default=0,
+        type=int,
+        required=False,
+        help="Seed of the random generator. Default is 0")
+    parser.add_argument('-o', '--output',
+        default=os.path.join(ROOT, 'benchmarks', 'results.json'),
+        type=str,
+        required=False,
+        help="Output filename where save the results, in JSON. Default is benchmarks/results.json")
+    parser.add_argument('-b', '--baseline',
+        default=None,
+        type=str,
+        required=False,
+        help="Results of a previous run (see --output) to compare with. If the file does not exist yet, the results are "
+             "saved as the baseline, to compare the next runs with. Default is None, i.e. no comparison")
+    parser.add_argument('--update_baseline',
+        default=False,
+        action='store_true',
+        help="If specified the results are also saved as the new --baseline, without comparing them. Default is False")
+    parser.add_argument('--tolerance',
+        default=0.25,
+        type=float,
+        required=False,
+        help="Relative slowdown, with respect to the baseline, flagged as a regression. Default is 0.25")
+    parser.add_argument('--min_delta',
+        default=0.01,
+        type=float,
+        required=False,
+        help="Minimum absolute slowdown (in seconds) flagged as a regression, to ignore the noise of the fastest "
+             "stages. Default is 0.01")
+
+    return parser.parse_args()
+
+
+def generate_taxonomy(n, depth=7, branching=6, rnd=random):
+    """
+    Generate ``n`` distinct features, with a random number of levels between 2 and ``depth``, where the internal
+    clades have ``branching`` children each and each leaf is unique.
+    Return the list of features as lists of levels, e.g., ['k__K0', 'p__P3', 'c__f12'].
+    """
+    depth = min(depth, len(LEVELS))
+    taxonomy = []
+
+    for i in range(n):
+        lvls = rnd.randint(2, depth)
+        clades = [LEVELS[l] + '__' + LEVELS[l].upper() + str(rnd.randint(0, branching - 1)) for l in range(lvls - 1)]
+        taxonomy.append(clades + [LEVELS[lvls - 1] + '__f' + str(i)])
+
+    return taxonomy
+
+
+def generate_abundances(n, samples, rnd=random):
+    """
+    Return ``n`` rows of ``samples`` relative abundances, about half of them zeros.
+    """
+    return [[rnd.expovariate(1.) if rnd.random() < .5 else 0. for _ in range(samples)] for _ in range(n)]
+
+
+def write_lefse_input(filename, taxonomy, abundances):
+    """
+    Write the features, '|'-separated as in MetaPhlAn, and their abundances as a tab-separated LEfSe input.
+    """
+    with open(filename, 'w') as f:
+        f.write('\t'.join(['ID'] + ['S' + str(j) for j in range(len(abundances[0]))]) + '\n')
+
+        for clades, row in zip(taxonomy, abundances):
+            f.write('\t'.join(['|'.join(clades)] + ['{0:.6f}'.format(v) for v in row]) + '\n')
+
+
+def write_lefse_output(filename, taxonomy, biomarker_rate=0.1, rnd=random):
+    """
+    Write all the clades of ``taxonomy``, internal ones included, as a LEfSe output where a ``biomarker_rate`` fraction
+    of them are biomarkers.
+    """
+    clades = set()
+
+    for c in taxonomy:
+        for l in range(1, len(c) + 1):
+            clades.add('.'.join(c[:l]))
+
+    with open(filename, 'w') as f:
+        for c in sorted(clades):
+            m = '{0:.6f}'.format(rnd.uniform(0., 6.))
+
+            if rnd.random() < biomarker_rate:
+                f.write('\t'.join([c, m, rnd.choice(CLASSES), '{0:.6f}'.format(rnd.uniform(2., 5.)),
+                                   '{0:.6g}'.format(rnd.uniform(0., .05))]) + '\n')
+            else:
+                f.write('\t'.join([c, m, '', '', '-']) + '\n')
+
+
+def write_biom(filename, taxonomy, abundances, dup_rate=0.1, rnd=random):
+    """
+    Write a sparse BIOM table of OTUs with the taxonomy in their metadata, where a ``dup_rate`` fraction of the OTUs
+    share the taxonomy of another OTU.
+    """
+    import numpy as np
+    from biom.table import Table
+    from scipy.sparse import coo_matrix
+
+    metadata = []
+
+    for i, clades in enumerate(taxonomy):
+        if i and (rnd.random() < dup_rate):
+            clades = taxonomy[rnd.randint(0, i - 1)]
+
+        metadata.append({'taxonomy': clades})
+
+    data = coo_matrix(np.array(abundances))
+    table = Table(data, ['OTU' + str(i) for i in range(len(taxonomy))],
+                  ['S' + str(j) for j in range(len(abundances[0]))], metadata)
+
+    with open(filename, 'w') as f:
+        f.write(table.to_json('export2graphlan benchmark suite'))
+
+
+def generate_inputs(folder, n, args):
+    """
+    Generate the inputs with ``n`` features in ``folder``.
+    Return the dict of the generated filenames and the list of the clades for --background_clades.
+    """
+    rnd = random.Random(args.seed + n)
+    taxonomy = generate_taxonomy(n, args.depth, args.branching, rnd)
+    abundances = generate_abundances(n, args.samples, rnd)
+    files = dict([(k, os.path.join(folder, k + '_' + str(n) + ext))
+                  for k, ext in [('lefse_input', '.txt'), ('lefse_output', '.res'), ('biom', '.biom')]])
+
+    write_lefse_input(files['lefse_input'], taxonomy, abundances)
+    write_lefse_output(files['lefse_output'], taxonomy, args.biomarker_rate, rnd)
+    write_biom(files['biom'], taxonomy, abundances, args.dup_rate, rnd)
+
+    background = sorted(set(['.'.join(c[:2]) for c in taxonomy]))[:args.background_clades]
+    return files, background
+
+
+def case_argv(case, files, background, folder):
+    """
+    Return the export2graphlan.py arguments of ``case``.
+    """
+    argv = ['--tree', os.path.join(folder, 'tree.txt'), '--annotation', os.path.join(folder, 'annot.txt'),
+            '--annotations', '2,3', '--external_annotations', '4,5']
+
+    if background:
+        argv += ['--background_clades', ', '.join(background), '--background_levels', '1']
+
+    if case == 'tsv':
+        return argv + ['-i', files['lefse_input'], '-o', files['lefse_output'], '--internal_levels']
+    elif case == 'tsv_no_output':
+        return argv + ['-i', files['lefse_input']]
+    elif case == 'biom':
+        return argv + ['-i', files['biom'], '--internal_levels']
+
+    raise Exception('[case_argv()] Unknown case: ' + case)
+
+
+def run_case(argv, repeats):
+    """
+    Run the conversion ``repeats`` times. A conversion that returns errors fails the case, as its time is meaningless.
+    Return the dict with the minimum time of each stage and of the full conversion, the peak memory, and the counts.
+    """
+    result = {}
+    stdout = sys.stdout
+
+    for _ in range(repeats):
+        profiler = e2g.Profiler()
+        sys.stdout = open(os.devnull, 'w')  # silence the messages of the conversion
+
+        try:
+            start = default_timer()
+            errors = e2g.run(e2g.read_params(argv), profiler=profiler)
+            total = default_timer() - start
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+        if errors:
+            raise Exception('[run_case()] The conversion failed: ' + '; '.join(errors))
+
+        profiler.stop()
+        stages = {'total': total}
+
+        for name, seconds, _ in profiler.stages:
+            stages[name] = stages.get(name, 0.) + seconds
+
+        for name, seconds in stages.iteritems():
+            result[name] = min(result.get(name, seconds), seconds)
+
+    return {'seconds': result,
+            'peak_rss_mb': max([rss for _, _, rss in profiler.stages if rss is not None] or [None]),
+            'counts': dict(profiler.counts)}
+
+
+def compare(results, baseline, tolerance=0.25, min_delta=0.01):
+    """
+    Print the comparison of each stage time with the baseline.
+    Return the number of regressions.
+    """
+    regressions = 0
+    print '\t'.join(['case', 'stage', 'baseline (s)', 'current (s)', 'ratio', 'status'])
+
+    for key in sorted(results):
+        if key not in baseline:
+            continue
+
+        for stage in sorted(results[key]['seconds']):
+            if stage not in baseline[key]['seconds']:
+                continue
+
+            old = baseline[key]['seconds'][stage]
+            new = results[key]['seconds'][stage]
+            status = 'ok'
+
+            if (new > old * (1. + tolerance)) and (new - old > min_delta):
+                status = 'REGRESSION'
+                regressions += 1
+
+            print '\t'.join([key, stage, '{0:.4f}'.format(old), '{0:.4f}'.format(new),
+                             '{0:.2f}'.format(new / old) if old else 'n/a', status])
+
+    return regressions
+
+
+def main():
+    args = read_params()
+    sizes = [int(s) for s in args.sizes.split(',')]
+    cases = [c.strip() for c in args.cases.split(',')]
+    folder = mkdtemp()
+    results = {}
+    failed = []
+
+    try:
+        print '\t'.join(['case', 'features', 'total (s)', 'peak RSS (MB)', 'slowest stage'])
+
+        for n in sizes:
+            files, background = generate_inputs(folder, n, args)
+
+            for case in cases:
+                key = case + '/' + str(n)
+
+                try:
+                    results[key] = run_case(case_argv(case, files, background, folder), args.repeats)
+                except Exception as e:
+                    failed.append(key)
+                    print '\t'.join([case, str(n), 'FAILED', str(e)])
+                    continue
+
+                seconds = results[key]['seconds']
+                slowest = max([s for s in seconds if s != 'total'], key=seconds.get)
+                rss = results[key]['peak_rss_mb']
+                print '\t'.join([case, str(n), '{0:.4f}'.format(seconds['total']),
+                                 '{0:.1f}'.format(rss) if rss is not None else 'n/a',
+                                 slowest + ' ({0:.4f} s)'.format(seconds[slowest])])
+    finally:
+        rmtree(folder)
+
+    report = {'params': dict([(p, getattr(args, p)) for p in ['samples', 'depth', 'branching', 'dup_rate',
+                                                                'biomarker_rate', 'background_clades', 'repeats',
+                                                                'seed']]),
+              'python': platform.python_version(),
+              'export2graphlan': e2g.__version__,
+              'results': results}
+
+    # the first run with a --baseline that does not exist yet stores it
+    update_baseline = args.baseline and (args.update_baseline or not os.path.isfile(args.baseline))
+
+    if failed:  # the results are saved, but never as the baseline
+        update_baseline = False
+
+    for filename in [args.output] + ([args.baseline] if update_baseline else []):
+        with open(filename, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    print ' '.join(["[i] Results saved in", args.output] + (["and in the baseline", args.baseline]
+                                                             if update_baseline else []))
+
+    if failed:
+        print ' '.join(["[e]", str(len(failed)), "failed cases:", ', '.join(failed)])
+        exit(1)
+
+    if args.baseline and not update_baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+
+        if baseline['params'] != report['params']:
+            print "[W] The baseline was generated with different params, the comparison may not be meaningful"
+
+        print
+        regressions = compare(results, baseline['results'], args.tolerance, args.min_delta)
+
+        if regressions:
+            print ' '.join(["[e]", str(regressions), "regressions with respect to", args.baseline])
+            exit(1)
+
+        print ' '.join(["[i] No regressions with respect to", args.baseline])
+
+
+if __name__ == '__main__':
+    main()
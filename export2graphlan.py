@@ -2,13 +2,26 @@
 
 
 import os
-import numpy as np
+import sys
+import gzip
+import json
+import mmap
+import shlex
+import tempfile
+import threading
+from array import array
 from argparse import ArgumentParser
+from collections import Counter
+from copy import copy
+from hashlib import sha1
+from heapq import heappush, heapreplace, nlargest
+from itertools import izip
 from colorsys import hsv_to_rgb
-from math import log10
+from math import isinf, isnan, log10
 from StringIO import StringIO
+from timeit import default_timer
 from re import compile
-from hclust2 import DataMatrix
+from string import maketrans
 
 
 __author__ = 'Francesco Asnicar'
@@ -43,10 +56,9 @@ def scale_color((h, s, v), factor=1.0):
     return '#{0:02x}{1:02x}{2:02x}'.format(int(round(r*255.)), int(round(g*255.)), int(round(b*255.)))
 
 
-def read_params():
+def params_parser():
     """
-    Parse the input parameters, performing some validity check.
-    Return the parsed arguments.
+    Return the parser of the input parameters, without the DataMatrix ones of hclust2.
     """
     parser = ArgumentParser(description="export2graphlan.py (ver. "+__version__+
         " of "+__date__+"). Convert MetaPhlAn, LEfSe, and/or HUMAnN output to GraPhlAn input format. Authors: "+
@@ -75,6 +87,23 @@ def read_params():
         type=str,
         required=True,
         help="Output filename where save GraPhlAn annotation")
+    group.add_argument('--buffer_size',
+        default=10000,
+        type=int,
+        required=False,
+        help="Number of rows collected before writing them to the tree and annotation files. Output filenames ending "
+             "with .gz are gzip-compressed. Default is 10000")
+    group.add_argument('--profile',
+        default=None,
+        choices=['table', 'json'],
+        required=False,
+        help="Report the wall time and the peak resident memory of each stage of the conversion, and the number of "
+             "processed items, either as a tab-separated table or as JSON. Default is None, i.e. no report")
+    group.add_argument('--profile_file',
+        default=None,
+        type=str,
+        required=False,
+        help="Output filename where save the --profile report. Default is None, i.e. print it to the standard output")
 
     # annotations
     parser.add_argument('--annotations',
@@ -200,14 +229,135 @@ def read_params():
     type=str,
     required=False,
     help="Mapping file that associates biomarkers to a specific color... I'll define later the specific format of this file!")
+    # cache of the parsed lefse_input
+    parser.add_argument('--cache_dir',
+        default=None,
+        type=str,
+        required=False,
+        help="Folder where to cache the parsed lefse_input, so that runs with the same input file and parsing params "
+             "(e.g., --discard_otus, --internal_levels, --fname_row, --ftop) do not parse it again. Default is None, "
+             "i.e. no cache")
+    parser.add_argument('--cache_size',
+        default=1024,
+        type=int,
+        required=False,
+        help="Maximum size (in MB) of the cache folder, the least recently used entries are removed first. Default "
+             "is 1024")
+    # write the most common values as GraPhlAn '*' defaults
+    parser.add_argument('--compact_annotation',
+        default=False,
+        action='store_true',
+        help="If specified the most common clade marker size is written once as a '*' default for all the clades, and "
+             "only the clades that differ from it get their own line. Default is False, i.e. one line for each clade")
+    parser.add_argument('--leaf_paths',
+        default=False,
+        action='store_true',
+        help="If specified only the paths from the root to the leaves are written to the tree file, as GraPhlAn "
+             "rebuilds the internal clades (that are still annotated) from them. Default is False, i.e. one line for "
+             "each clade")
+    parser.add_argument('--annotation_workers',
+        default=1,
+        type=int,
+        required=False,
+        help="Number of worker processes that write the annotation of the clades, split in shards of consecutive "
+             "clades and merged in order, so that the annotation is the same as with a single process. Default is 1")
+    # skip the conversion when nothing changed since the previous one
+    parser.add_argument('--incremental',
+        default=False,
+        action='store_true',
+        help="If specified a manifest with the hashes of the input files, of the params and of the outputs is kept "
+             "next to the annotation file (with the .manifest extension), and the conversion is skipped, leaving the "
+             "outputs untouched, when none of them changed since the previous run. Default is False, i.e. always "
+             "convert")
+    # write many variants of the annotation from a single parse of the inputs
+    parser.add_argument('--sweep',
+        default=None,
+        type=str,
+        required=False,
+        help="Tab-separated file with one variant per line: its name and the options that change with respect to the "
+             "command line, e.g., \"thr10<TAB>--abundance_threshold 10 --annotations 2,3\". The inputs are parsed once "
+             "and each variant is written to the --tree and --annotation filenames with .<name> before their extension "
+             "(unless the variant gives its own). The input files and their parsing params cannot change across the "
+             "variants. Default is None, i.e. a single conversion")
+
+    return parser
+
+
+def argv_error(message):
+    """
+    Raise the argparse error ``message`` as an Exception, instead of printing the usage and exiting.
+    """
+    raise Exception(message)
+
+
+def read_params(argv=None):
+    """
+    Parse the input parameters (from the command line, or from ``argv`` if given), performing some validity check. The
+    errors in ``argv`` (e.g., the options of a batch or server job) are raised, with their message, as an Exception.
+    Return the parsed arguments.
+    """
+    parser = params_parser()
+
+    if argv is not None:
+        parser.error = argv_error
+
+    # hclust2 (and its scientific stack) is imported only when there is an input matrix to load, or for the help
+    pre_parser = ArgumentParser(add_help=False)
+    pre_parser.add_argument('-h', '--help', action='store_true')
+    pre_parser.add_argument('-i', '--lefse_input', type=str)
+    pre_args, _ = pre_parser.parse_known_args(argv)
+    args, unknown = None, True
 
-    DataMatrix.input_parameters(parser)
-    args = parser.parse_args()
+    if not (pre_args.help or pre_args.lefse_input):
+        args, unknown = parser.parse_known_args(argv)
+
+    if unknown:
+        from hclust2 import DataMatrix
+
+        DataMatrix.input_parameters(parser)
+        args = parser.parse_args(argv)
 
     # check if at least one of the input params is given
     if (not args.lefse_input) and (not args.lefse_output):
         raise Exception("[read_params()] You must provide at least one of the two input parameters: ")
 
+    return check_params(args)
+
+
+def default_params(**options):
+    """
+    Build the input parameters without the command line, for calling read_lefse_input() and convert() from Python: the
+    default values, including the DataMatrix ones when there is a ``lefse_input`` (or a DataMatrix option) given, are
+    updated with the given ``options``, e.g., default_params(annotations='2,3', title='Title').
+    Return the checked arguments.
+    """
+    parser = params_parser()
+    argv = ['--tree', '', '--annotation', '']
+    args = parser.parse_args(argv)
+
+    # hclust2 is imported only when there is an input matrix to load, as in read_params()
+    if options.get('lefse_input') or (set(options) - set(vars(args))):
+        from hclust2 import DataMatrix
+
+        DataMatrix.input_parameters(parser)
+        args = parser.parse_args(argv)
+
+    unknown = sorted(set(options) - set(vars(args)))
+
+    if unknown:
+        raise Exception('[default_params()] Unknown parameters: ' + ', '.join(unknown))
+
+    for k, v in options.iteritems():
+        setattr(args, k, v)
+
+    return check_params(args)
+
+
+def check_params(args):
+    """
+    Perform some validity check on the input parameters.
+    Return the checked arguments.
+    """
     # check that min_clade_size is less than max_clade_size
     if args.min_clade_size > args.max_clade_size:
         print "[W] min_clade_size cannot be greater than max_clade_size, assigning their default values"
@@ -220,6 +370,12 @@ def read_params():
         args.min_font_size = 8
         args.max_font_size = 12
 
+    if args.sweep and args.incremental:
+        raise Exception("[check_params()] --incremental cannot be used together with --sweep")
+
+    if args.annotation_workers < 1:
+        raise Exception("[check_params()] --annotation_workers must be at least 1")
+
     return args
 
 
@@ -230,540 +386,2013 @@ def get_file_type(filename):
     return filename[filename.rfind('.')+1:].lower()
 
 
-def parse_biom(filename, keep_otus=True, internal_levels=False):
+def temp_filename(filename):
     """
-    Load a biom table and extract the taxonomy (from metadata), removing the unuseful header.
-    Return the input biom in tab-separated format.
+    Return a temporary filename in the folder of ``filename``, with its same extension (that selects the compression),
+    unique to the current process and thread.
     """
-    from biom import load_table # avoid to ask for the BIOM library if there is no biom file
+    folder, name = os.path.split(filename)
+    root, ext = os.path.splitext(name)
+    return os.path.join(folder, '.'.join(['', root, str(os.getpid()), str(threading.current_thread().ident), 'tmp']) +
+                        ext)
 
-    biom_table = load_table(filename)
-    strs = biom_table.delimited_self(header_value='TAXA', header_key='taxonomy')
-    lst1 = [str(s) for s in strs.split('\n')[1:]] # skip the "# Constructed from biom file" entry
-    biom_file = []
-    out = [lst1[0]] # save the header
-    # pre_taxa = compile(".__")
-    classs = compile("\(class\)")
 
-    # consistency check
-    i = 0
-    while i < (len(lst1)-1):
-        if len([s for s in lst1[i].split('\t')]) != len([s for s in lst1[i+1].split('\t')]):
-            raise Exception('[parse_biom()] It seems that taxonomic metadata are missing, maybe is the wrong biom file?')
+class RowWriter(object):
+    """
+    Collects tab-separated rows in a buffer and writes them in blocks of ``buffer_size`` rows. If ``filename`` ends
+    with .gz the output is gzip-compressed while streaming. Without ``filename`` the rows are kept in memory, and
+    getvalue() returns them as text. With ``atomic`` the rows are written to a temporary file, that commit() renames
+    to ``filename`` and discard() removes (as it happens when leaving the context on an exception), so that the
+    previous ``filename`` is replaced only by a complete output.
+    """
+    def __init__(self, filename=None, buffer_size=10000, atomic=False):
+        self.filename = filename
+        self.path = temp_filename(filename) if atomic and (filename is not None) else filename
+
+        if filename is None:
+            self.handle = StringIO()
+        else:
+            self.handle = gzip.open(self.path, 'wb') if get_file_type(filename) == 'gz' else open(self.path, 'w')
+
+        self.buffer_size = max(1, buffer_size)
+        self.buffer = []
+        self.lines = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+        if exc_type is not None:
+            self.discard()
+
+    def write(self, *rows):
+        """
+        Append each row, a list of fields, to the buffer. An empty row writes an empty line.
+        """
+        for row in rows:
+            self.buffer.append('\t'.join(row))
+
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.lines += len(self.buffer)
+            self.buffer.append('')
+            self.handle.write('\n'.join(self.buffer))
+            del self.buffer[:]
+
+    def write_text(self, text, lines):
+        """
+        Write ``text``, already formatted as ``lines`` rows, after the rows in the buffer.
+        """
+        self.flush()
+        self.lines += lines
+        self.handle.write(text)
+
+    def getvalue(self):
+        self.flush()
+        return self.handle.getvalue()
+
+    def close(self):
+        if not self.handle.closed:
+            self.flush()
+
+            if self.filename is not None:
+                self.handle.close()
+
+    def commit(self):
+        """
+        Rename the temporary file of an ``atomic`` writer to ``filename``.
+        """
+        self.close()
+
+        if self.path != self.filename:
+            os.rename(self.path, self.filename)
+            self.path = self.filename
+
+    def discard(self):
+        """
+        Remove the temporary file of an ``atomic`` writer, leaving ``filename`` untouched.
+        """
+        self.close()
+
+        if (self.path != self.filename) and os.path.isfile(self.path):
+            os.remove(self.path)
+
+
+class ShardWriter(object):
+    """
+    Collects the rows written for a shard of the annotation, that getvalue() returns as text with their number, to be
+    written in order by merge_shards().
+    """
+    def __init__(self):
+        self.rows = []
 
-        i += 1
+    def write(self, *rows):
+        for row in rows:
+            self.rows.append('\t'.join(row))
 
-    for l in lst1[1:]:
-        otu = None
-        lst = [float(s.strip()) for s in l.split('\t')[1:-1]]
+    def getvalue(self):
+        return ''.join(['\n'.join(self.rows), '\n']) if self.rows else '', len(self.rows)
 
-        if keep_otus:
-            otu = l.split('\t')[0]
 
-        # Clean and move taxa in first place
-        taxa = '.'.join([s.strip().replace('u\'', '').replace(' ', '').replace('\'', '').replace('[', '').replace(']', '').replace('{', '').replace('}', '').replace('(', '').replace(')', '').replace('=', '_').replace('-', '_')
-                         for s in l.split('\t')[-1].split(',')])
-        taxa = pre_taxa.sub('', taxa)  # remove '{k|p|c|o|f|g|s|t}__'
-        taxa = classs.sub('', taxa)  # remove '(class)'
-        taxa = taxa.rstrip('.')  # remove trailing dots
-        taxa = taxa.rstrip('_')  # remove trailing underscores
+def peak_rss():
+    """
+    Return the peak resident memory of the process, in MB, or None if it cannot be measured on this platform.
+    """
+    try:
+        import resource
+    except ImportError:  # e.g., on Windows
+        return None
 
-        if otu:
-            taxa = taxa + '.' + otu
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024. / 1024. if sys.platform == 'darwin' else rss / 1024.  # bytes on macOS, KB on Linux
 
-        biom_file.append([taxa] + lst)
 
-    # merge such rows that have the same taxa
-    i = 1
-    dic = {}
+class Profiler(object):
+    """
+    Records the wall time and the peak resident memory of the stages of a conversion, and the number of processed
+    items. Stages are sequential: stage() closes the running one and starts the next, stop() closes the last one.
+    """
+    def __init__(self):
+        self.stages = []
+        self.counts = []
+        self.running = None
 
-    for l in biom_file[i:]:
-        if l[0] not in dic:
-            dic[l[0]] = l[1:]
+    def stage(self, name):
+        now = default_timer()
 
-            for k in biom_file[i+1:]:
-                if l[0] == k[0]:
-                    lst = []
-                    lstdic = dic[l[0]]
-                    j = 1
-                    while j < len(lstdic):
-                        lst.append(float(lstdic[j]) + float(k[j]))
-                        j += 1
+        if self.running is not None:
+            running, start = self.running
+            self.stages.append((running, now - start, peak_rss()))
 
-                    dic[l[0]] = lst
-        i += 1
+        self.running = (name, now) if name is not None else None
 
-    feats = dict(dic)
+    def stop(self):
+        self.stage(None)
 
-    if internal_levels:
-        feats = add_missing_levels(feats)
+    def count(self, name, value):
+        self.counts.append((name, value))
 
-    for k in feats:
-        out.append('\t'.join([str(s) for s in [k] + feats[k]]))
+    def report(self, fmt='table'):
+        """
+        Return the report of the recorded stages and counts, either as a tab-separated table or as JSON.
+        """
+        self.stop()
+        total = sum([seconds for _, seconds, _ in self.stages])
 
-    return '\n'.join(out)
+        if fmt == 'json':
+            return json.dumps({'stages': [{'name': name, 'seconds': seconds, 'peak_rss_mb': rss}
+                                          for name, seconds, rss in self.stages],
+                               'total_seconds': total,
+                               'counts': dict(self.counts)}, indent=2, sort_keys=True)
 
+        rows = [['stage', 'time (s)', 'peak RSS (MB)']]
+        rows += [[name, '{0:.4f}'.format(seconds), '{0:.1f}'.format(rss) if rss is not None else 'n/a']
+                 for name, seconds, rss in self.stages]
+        rows += [['total', '{0:.4f}'.format(total), ''], [], ['item', 'count']]
+        rows += [[name, str(value)] for name, value in self.counts]
+        return '\n'.join(['\t'.join(row) for row in rows])
 
-def add_missing_levels(ff, summ=True):
+
+class NameNormalizer(object):
     """
-    Sum-up the internal abundances from leaf to root
+    Normalizes the raw taxonomy names with a single translation table: quotes (and the u' prefix of unicode reprs),
+    spaces, brackets, braces and parenthesis are removed, and '=' and '-' are replaced by '_'. It also builds the display
+    names, without the '{k|p|c|o|f|g|s|t}__' prefixes and with spaces instead of '_'. The single levels and the display
+    names, repeated across the features, are memoized per raw name, forgetting them all when more than ``max_size``
+    names are stored. The full taxonomies are unique within an input, and are not memoized.
     """
-    if sum([f.count(".") for f in ff]) < 1:
-        return ff
+    TABLE = maketrans('=-', '__')
+    DELETE = '\' []{}()'
+    UNICODE_TABLE = dict([(ord(c), None) for c in DELETE] + [(ord(c), u'_') for c in '=-'])
 
-    clades2leaves = {}
-    for f in ff:
-        fs = f.split(".")
+    def __init__(self, max_size=1 << 20):
+        self.max_size = max_size
+        self.names = {}
+        self.labels = {}
 
-        if len(fs) < 2:
-            continue
+    def memo(self, cache, name, value):
+        if len(cache) >= self.max_size:
+            cache.clear()
 
-        for l in range(1, len(fs)+1):
-            n = ".".join(fs[:l])
+        cache[name] = value
+        return value
 
-            if n in clades2leaves:
-                clades2leaves[n].append(f)
-            else:
-                clades2leaves[n] = [f]
+    def normalize(self, name):
+        """
+        Return the normalized ``name``, without memoization.
+        """
+        name = name.strip().replace('u\'', '')
 
-    ret = {}
-    for k in clades2leaves:
-        if summ:
-            ret[k] = [sum([sum(ff[e]) for e in clades2leaves[k]])]
-        else:
-            lst = []
-            for e in clades2leaves[k]:
-                if not lst:
-                    for i in ff[e]:
-                        lst.append(i)
-                else:
-                    lst1 = []
-                    i = 0
-                    while i < len(lst):
-                        lst1.append(lst[i] + ff[e][i])
-                        i += 1
-                    lst = lst1
+        if isinstance(name, unicode):
+            return name.translate(self.UNICODE_TABLE)
 
-            ret[k] = lst
+        return name.translate(self.TABLE, self.DELETE)
 
-    return ret
+    def clean(self, name):
+        """
+        Return the normalized ``name`` (e.g., a single level of a BIOM taxonomy).
+        """
+        clean = self.names.get(name)
+        return clean if clean is not None else self.memo(self.names, name, self.normalize(name))
 
+    def taxonomy(self, name):
+        """
+        Return the normalized taxonomy ``name``, with its levels separated by '.' instead of '|'.
+        """
+        return self.normalize(name.replace('|', '.'))
 
-def get_most_abundant(abundances, xxx):
+    def label(self, name):
+        """
+        Return the display name of ``name``.
+        """
+        label = self.labels.get(name)
+        return label if label is not None else self.memo(self.labels, name,
+                                                         pre_taxa.sub('', name).replace('_', ' '))
+
+
+normalizer = NameNormalizer()
+
+
+class Clade(object):
     """
-    Sort by the abundance level all the taxonomy that represent at least two levels.
-    Return the first ``xxx`` most abundant.
+    A node of the taxonomy tree. Holds the full (interned) taxonomy string, its last level, its display name, its
+    depth, the abundance, and the LEfSe results associated to the clade.
     """
-    abundant = []
+    __slots__ = ('taxonomy', 'name', 'label', 'level', 'parent', 'children', 'abundance',
+                 'effect_size', 'biomarker', 'mean', 'pvalue')
+
+    def __init__(self, name, parent=None):
+        self.taxonomy = intern(str('.'.join([parent.taxonomy, name]) if (parent is not None) and parent.level else name))
+        self.name = name
+        self.label = normalizer.label(name)
+        self.level = (parent.level + 1) if parent is not None else 0
+        self.parent = parent
+        self.children = {}
+        self.abundance = None
+        self.effect_size = None
+        self.biomarker = None
+        self.mean = None
+        self.pvalue = None
+
+    def lineage(self):
+        """
+        Return the list of clades from the first level down to this clade.
+        """
+        lst = []
+        node = self
 
-    for a in abundances:
-        if a.count('|') > 0:
-            abundant.append((float(abundances[a]), a.replace('|', '.')))
-        elif a.count('.') > 0:
-            abundant.append((float(abundances[a]), a))
+        while node.level:
+            lst.append(node)
+            node = node.parent
 
-    abundant.sort(reverse=True)
-    return abundant[:xxx]
+        return lst[::-1]
 
 
-def get_biomarkes(abundant, xxx):
+class Taxonomy(object):
     """
-    Split the taxonomy and then look, level by level, when there are at least ``xxx`` distinct branches.
-    Return the set of branches as biomarkers to highlight.
+    Prefix tree of the taxonomy, where each dot-separated level is a Clade. Clades are created once and then looked
+    up by their full taxonomy string.
     """
-    cc = []
-    old_bk = set()
-    lvl = 0
+    def __init__(self):
+        self.root = Clade('')
+        self.clades = {}
 
-    for _, t in abundant:
-        cc.append(t.split('.'))
+    def __len__(self):
+        return len(self.clades)
 
-    while lvl < len(max(cc)):
-        bk = set()
+    def __iter__(self):
+        return iter(self.clades.itervalues())
 
-        for c in cc:
-            if lvl < len(c):
-                bk |= set([c[lvl]])
+    def __contains__(self, taxonomy):
+        return taxonomy in self.clades
 
-        if len(bk) >= xxx:
-            break
+    def get(self, taxonomy):
+        return self.clades.get(taxonomy)
 
-        if len(old_bk) > len(bk):
-            bk = old_bk
-            break
+    def add(self, taxonomy):
+        """
+        Insert ``taxonomy`` and all its intermediate levels in the tree.
+        Return the Clade of ``taxonomy``.
+        """
+        node = self.clades.get(taxonomy)
 
-        old_bk = bk
-        lvl += 1
+        if node is not None:
+            return node
 
-    return bk
+        node = self.root
 
-def scale_clade_size(minn, maxx, abu, max_abu):
+        for name in taxonomy.split('.'):
+            child = node.children.get(name)
+
+            if child is None:
+                child = Clade(name, node)
+                node.children[name] = child
+                self.clades[child.taxonomy] = child
+
+            node = child
+
+        return node
+
+    def sorted(self):
+        """
+        Return all the clades sorted by taxonomy.
+        """
+        return [self.clades[t] for t in sorted(self.clades)]
+
+
+def sparse_percentiles(matrix, perc):
     """
-    Return the value of ``abu`` scaled to ``max_abu`` logarithmically, and then map from ``minn`` to ``maxx``.
+    Compute the ``perc`` percentile of each row of the sparse (CSR) ``matrix``, implicit zeros included, as scipy's
+    scoreatpercentile() does, but sorting only the stored values of each row.
+    Return the array of percentiles.
     """
-    return minn + (maxx-minn) * log10(1. + 9. * (abu/max_abu))
+    import numpy as np
 
+    ncols = matrix.shape[1]
+    idx = perc / 100. * (ncols - 1)
+    i = int(idx)
 
-def main():
+    if i == idx:
+        positions, weights, sumval = [i], np.array(1), 1.0
+    else:
+        positions, weights = [i, i + 1], np.array([(i + 1 - idx), (idx - i)], float)
+        sumval = weights.sum()
+
+    percs = np.empty(matrix.shape[0])
+
+    for r in range(matrix.shape[0]):
+        values = np.sort(matrix.data[matrix.indptr[r]:matrix.indptr[r + 1]])  # NaNs are sorted last
+        zeros = ncols - len(values)
+        negatives = np.searchsorted(values, 0.)
+        picked = [values[p] if p < negatives else (0. if p < negatives + zeros else values[p - zeros])
+                  for p in positions]
+        percs[r] = np.add.reduce(np.array(picked) * weights) / sumval
+
+    return percs
+
+
+def select_top(matrix, perc, top):
     """
+    Select the rows of the sparse ``matrix`` whose ``perc`` percentile is among the ``top`` highest, as done by the
+    ``--ftop`` and ``--stop`` params of hclust2's DataMatrix.
+    Return the boolean mask of the selected rows.
     """
-    # HSV
-    colors = [(245., 90., 100.), # blue
-              (125., 80., 80.), # green
-              (0., 80., 100.), # red
-              (195., 100., 100.), # cyan
-              (150., 100., 100.), # light green
-              (55., 100., 100.), # yellow
-              (280., 80., 88.)] # purple
-    args = read_params()
-    lefse_input = None
-    lefse_output = {}
-    color = {}
-    biomarkers = set()
-    taxa = []
-    abundances = {}
-    max_abundances = None
-    max_effect_size = None
-    max_log_effect_size = None
-    background_list = []
-    background_clades = []
-    background_colors = {}
-    annotations_list = []
-    external_annotations_list = []
-    lin = False
-    lout = False
+    percs = sparse_percentiles(matrix, perc)
 
-    # get the levels that should be shaded
-    if args.background_levels:
-        background_list = [int(i.strip()) for i in args.background_levels.strip().split(',')]
+    if top <= len(percs):
+        m = sorted(percs)[-top]
+    else:
+        print 'W ftop param value (' + str(top) + ') out of bound (len:' + str(len(percs)) + '). Selecting all the values from input.'
+        m = min(percs)
 
-    # get the background_clades
-    if args.background_clades:
-        if get_file_type(args.background_clades) in ['txt']:
-            with open(args.background_clades, 'r') as f:
-                background_clades = [str(s.strip()) for s in f]
-        else: # it's a string in csv format
-            background_clades = [str(s.strip()) for s in args.background_clades.split(',')]
+    return percs >= m
 
-    # read the set of colors to use for the background_clades
-    if args.background_colors:
-        col = []
 
-        if get_file_type(args.background_colors) in ['txt']: # it's a mapping file
-            background_colors = dict([tuple(a.strip().split('\t')) for a in open(args.background_colors, 'r')])
-            # with open(args.background_colors, 'r') as f:
-            #     col = [str(s.strip()) for s in f]
-        else: # it's a string in csv format
-            col = [c.strip() for c in args.background_colors.split(',')]
+def parse_biom(filename, keep_otus=True, internal_levels=False, args=None, profiler=None):
+    """
+    Load a biom table and extract the taxonomy (from metadata), aggregating the sparse abundances of the OTUs that
+    share the same taxonomy and, optionally, of the internal levels. If ``args`` is given, the features and samples
+    selection params of hclust2 (``--ftop``, ``--stop``) are applied on the sparse matrix. The stages are recorded
+    in ``profiler``, if given.
+    Return the list of feature names and the dict of their average abundances.
+    """
+    profiler = profiler if profiler is not None else Profiler()
+    profiler.stage('BIOM parsing')
 
-        lst = {}
-        i = 0
+    import numpy as np
+    from biom import load_table # avoid to ask for the BIOM library if there is no biom file
+    from scipy.sparse import csr_matrix
 
-        if not background_colors:
-            for c in background_clades:
-                cc = c[:c.find('.')]
+    biom_table = load_table(filename)
+    metadata = biom_table.metadata(axis='observation')
+    # pre_taxa = compile(".__")
+    classs = compile("\(class\)")
 
-                if cc not in lst:
-                    background_colors[c] = col[i % len(col)]
-                    lst[cc] = col[i % len(col)]
-                    i += 1
-                else:
-                    background_colors[c] = lst[cc]
+    # consistency check
+    if (not metadata) or [md for md in metadata if (not md) or ('taxonomy' not in md)]:
+        raise Exception('[parse_biom()] It seems that taxonomic metadata are missing, maybe is the wrong biom file?')
 
-    # get the levels that will use the internal annotation
-    if args.annotations:
-        annotations_list = [int(i.strip()) for i in args.annotations.strip().split(',')]
+    rows = {}
+    taxa_idx = []
 
-    # get the levels that will use the external legend annotation
-    if args.external_annotations:
-        external_annotations_list = [int(i.strip()) for i in args.external_annotations.strip().split(',')]
+    for otu, md in zip(biom_table.ids(axis='observation'), metadata):
+        tax = md['taxonomy'] if isinstance(md['taxonomy'], basestring) else ','.join(md['taxonomy'])
 
-    # check overlapping between internal and external annotations
-    if set(annotations_list) & set(external_annotations_list):
-        print '[W] Some annotation levels are present in both internal and external params. The shared levels has been removed from the internal list.'
-        annotations_list = list(set(annotations_list) - set(external_annotations_list))
+        # Clean the taxa
+        taxa = '.'.join([normalizer.clean(s) for s in tax.split(',')])
+        taxa = pre_taxa.sub('', taxa)  # remove '{k|p|c|o|f|g|s|t}__'
+        taxa = classs.sub('', taxa)  # remove '(class)'
+        taxa = taxa.rstrip('.')  # remove trailing dots
+        taxa = taxa.rstrip('_')  # remove trailing underscores
 
-    if args.lefse_input:
-        # if the lefse_input is in biom format, convert it
-        if get_file_type(args.lefse_input) in 'biom':
-            try:
-                biom = parse_biom(args.lefse_input, args.discard_otus, args.internal_levels)
-                lefse_input = DataMatrix(StringIO(biom), args)
-            except Exception as e:
-                lin = True
-                print 'Exception:', e
-        else:
-            if args.internal_levels:
-                aaa = {}
-                header = None
-                with open(args.lefse_input, 'r') as f:
-                    for r in f:
-                        if header is None:
-                            header = [s.strip() for s in r.split('\t')]
-                        else:
-                            row = r.split('\t')
-                            aaa[row[0].strip().replace('|', '.')] = [float(s.strip()) for s in row[1:]]
-
-                feats = add_missing_levels(aaa, summ=False)
-                ss = '\t'.join(header) + '\n'
-                ss += '\n'.join(['\t'.join([str(s) for s in [k] + feats[k]]) for k in feats])
-                lefse_input = DataMatrix(StringIO(ss), args)
-            else:
-                lefse_input = DataMatrix(args.lefse_input, args)
+        if keep_otus:
+            taxa = taxa + '.' + str(otu)
+
+        # merge such rows that have the same taxa
+        if taxa not in rows:
+            rows[taxa] = len(rows)
 
-        if not lin:
-            taxa = [t.replace('|', '.').strip().replace('u\'', '').replace(' ', '').replace('\'', '').replace('[', '').replace(']', '').replace('{', '').replace('}', '').replace('(', '').replace(')', '').replace('=', '_').replace('-', '_')
-                    for t in lefse_input.get_fnames()]  # build taxonomy list
+        taxa_idx.append(rows[taxa])
 
-            # build all intermediate levels
-            inter_lvls = []
+    feats = sorted(rows, key=rows.get)
+    profiler.count('OTUs', len(taxa_idx))
 
-            for t in taxa:
-                s = ''
+    # sum-up the OTUs into their taxa, and the taxa into their clades, without densifying the matrix
+    profiler.stage('BIOM aggregation')
+    otus2taxa = csr_matrix((np.ones(len(taxa_idx)), (taxa_idx, range(len(taxa_idx)))), shape=(len(rows), len(taxa_idx)))
+    data = (otus2taxa * biom_table.matrix_data.tocsr()).tocsr()
 
-                for tt in t.split('.')[:-1]:
-                    s = '.'.join([s, tt]) if s else tt
+    if internal_levels:
+        profiler.stage('add_missing_levels')
+        feats, data = sum_internal_levels(feats, data)
+        profiler.stage('BIOM aggregation')
 
-                    if (s not in taxa) and (s not in inter_lvls):
-                        inter_lvls.append(s)
+    if args and (args.ftop > 0):
+        mask = select_top(data, args.fperc, args.ftop)
+        feats = [f for f, m in zip(feats, mask) if m]
+        data = data[np.flatnonzero(mask)]
 
-            taxa += inter_lvls
-            taxa.sort()
+    if args and args.stop:
+        data = data[:, np.flatnonzero(select_top(data.T.tocsr(), args.sperc, args.stop))]
 
-            # check for duplicate taxa entries
-            if len(taxa) != len(set(taxa)):
-                print "There are duplicate taxa entries, please check the input file!"
-                exit(1)
+    return feats, dict(zip(feats, np.asarray(data.mean(axis=1)).ravel().tolist()))
 
-            # check if there are abundances to extract
-            abundances = dict(lefse_input.get_averages())
-            tot_abu = sum([abundances[a] for a in abundances if np.isfinite(abundances[a])])
 
-            if tot_abu > 0:
-                max_abundances = max([abundances[x] for x in abundances])
-            else:
-                abundances = dict()
-                lin = False
-                print "abundances: empty"
-    else: # no lefse_input provided
-        lin = True
+def sum_internal_levels(feats, matrix):
+    """
+    Sum-up from leaf to root the rows of the sparse ``matrix``, one for each feature in ``feats``, with a sparse product
+    whose cost depends on the nonzero values only. Each clade gets the sum of its leaves, in input order, and the
+    features with a single level are discarded, as in add_missing_levels().
+    Return the list of clades and their sparse (CSR) matrix.
+    """
+    if not [f for f in feats if '.' in f]:
+        return feats, matrix
 
-    if args.lefse_output:
-        # if the lefse_output is in biom format... I don't think it's possible!
-        if get_file_type(args.lefse_output) in 'biom':
-            lout = True
-            print "Seriously?? LEfSe output file is not expected to be in biom format!"
-        else:
-            lst = []
+    import numpy as np
+    from scipy.sparse import csr_matrix
 
-            with open(args.lefse_output, 'r') as out_file:
-                for line in out_file:
-                    # print
-                    # print '>>>'+line+'<<<'
-                    # print
-                    t, m, bk, es, pv = line.strip().split('\t')
-                    lefse_output[t] = (es, bk, m, pv)
+    tree = Taxonomy()
+    clades = {}
+    rows = []
+    cols = []
 
-                    # get distinct biomarkers
-                    if bk:
-                        biomarkers |= set([bk])
+    # map each feature to its ancestors (and itself)
+    for i, f in enumerate(feats):
+        if '.' not in f:
+            continue
 
-                    # get all effect size
-                    if es:
-                        lst.append(float(es))
+        for node in tree.add(f).lineage():
+            if node.taxonomy not in clades:
+                clades[node.taxonomy] = len(clades)
 
-                max_effect_size = max(lst)
+            rows.append(clades[node.taxonomy])
+            cols.append(i)
 
-            # no lefse_input file provided!
-            if (not taxa) and (not abundances): # build taxonomy list and abundaces map
-                for t in lefse_output:
-                    _, _, m, _ = lefse_output[t]
-                    abundances[t.replace('.', '|')] = float(m)
+    leaves2clades = csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(clades), len(feats)))
+    return sorted(clades, key=clades.get), (leaves2clades * matrix).tocsr()
 
-                max_abundances = max([abundances[x] for x in abundances])
 
-                for t in lefse_output:
-                    scaled = scale_clade_size(args.min_clade_size, args.max_clade_size,
-                                              abundances[t.replace('.', '|')], max_abundances)
+def read_sparse_matrix(args):
+    """
+    Load the tab-separated ``lefse_input`` one row at a time (see read_matrix_rows()), keeping only the nonzero values
+    (missing values, if not replaced, are kept as NaN). When a feature is repeated its last row is kept.
+    Return the list of feature names and their sparse (CSR) matrix.
+    """
+    import numpy as np
+    from scipy.sparse import csr_matrix
 
-                    if scaled >= args.abundance_threshold:
-                        taxa.append(t.replace('|', '.').strip().replace('u\'', '').replace(' ', '').replace('\'', '').replace('[', '').replace(']', '').replace('{', '').replace('}', '').replace('(', '').replace(')', '').replace('=', '_').replace('-', '_'))
-    elif not lin:  # no lefse_output provided and lefse_input correctly red
-        lout = True
+    names = []
+    data = []
+    indices = []
+    indptr = [0]
+    ncols = 0
 
-        # find the xxx most abundant
-        abundant = get_most_abundant(abundances, args.most_abundant)
-        # print "abundant:", len(abundant), abundant
+    for name, values in read_matrix_rows(args):
+        row = np.array(values, dtype=float)
+        nonzero = np.flatnonzero(row)
+        names.append(name.strip().replace('|', '.'))
+        data.append(row[nonzero])
+        indices.append(nonzero)
+        indptr.append(indptr[-1] + len(nonzero))
+        ncols = max(ncols, len(row))
 
-        # find the taxonomy level with at least yyy distinct childs from the xxx most abundant
-        biomarkers = get_biomarkes(abundant, args.least_biomarkers)
-        # print "biomarkers:", len(biomarkers), biomarkers
+    matrix = csr_matrix((np.concatenate(data) if data else np.empty(0),
+                         np.concatenate(indices) if indices else np.empty(0, dtype=int), indptr),
+                        shape=(len(names), ncols))
+    last = dict([(n, i) for i, n in enumerate(names)])
 
-        # compose lefse_output variable
-        for _, t in abundant:
-            b = ''
+    if len(last) < len(names):
+        keep = sorted(last.values())
+        names, matrix = [names[i] for i in keep], matrix[keep]
 
-            for bk in biomarkers:
-                if bk in t:
-                    b = bk
+    return names, matrix
 
-            lefse_output[t] = (2., b, '', '')
 
-        max_effect_size = 2.  # It's not gonna work... Maybe now??!?
+def sparse_nanmean(matrix):
+    """
+    Return the list of the averages of the rows of the sparse ``matrix``, implicit zeros included and NaNs excluded, as
+    numpy's nanmean() does.
+    """
+    import numpy as np
 
-    # no lefse_output and no lefse_input provided
-    if lin and lout:
-        print "You must provide at least one input file!"
-        exit(1)
+    nans = np.isnan(matrix.data)
 
-    # write the tree
-    with open(args.tree, 'w') as tree_file:
-        tree_file.write('\n'.join(taxa))
+    if not nans.any():
+        return np.asarray(matrix.mean(axis=1)).ravel().tolist()
 
-    # for each biomarker assign it to a different color
-    if args.biomarkers2colors:
-        if os.path.isfile(args.biomarkers2colors):  # there exists a mapping file from biomarkers to colors read it
-            with open(args.biomarkers2colors) as f:
-                for row in f:
-                    if not row.startswith('#'):
-                        bk = row.strip().split('\t')[0]
-                        cl = tuple([float(i.strip()) for i in row.strip().split('\t')[1].split(',')])
-                        colors.append(cl)
-                        color[bk] = colors.index(cl)
-    else:  # assign them automagically!
-        i = 0
+    matrix = matrix.copy()
+    matrix.data[nans] = 0.
+    counts = matrix.shape[1] - np.bincount(np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))[nans],
+                                           minlength=matrix.shape[0])
+    sums = np.asarray(matrix.sum(axis=1)).ravel()
 
-        for bk in biomarkers:
-            color[bk] = i % len(colors)
-            i += 1
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (sums / counts).tolist()
 
-    # print "color:", color
 
-    # find max log abs value of effect size
-    if lefse_output:
-        lst = []
+def add_missing_levels(ff, summ=True):
+    """
+    Sum-up the internal abundances from leaf to root
+    """
+    if sum([f.count(".") for f in ff]) < 1:
+        return ff
 
-        for t in lefse_output:
-            es, _, _, _ = lefse_output[t]
+    import numpy as np
 
-            if es:
-                lst.append(abs(log10(float(es) / max_effect_size)))
+    tree = Taxonomy()
+    feats = [f for f in ff if '.' in f]
+    clades = {}
+    lineages = []
 
-        max_log_effect_size = max(lst)
+    # map each row to the ids of its ancestors (and itself)
+    for f in feats:
+        lineage = []
 
-    # write the annotation
-    try:
-        with open(args.annotation, 'w') as annot_file:
-            # set the title
-            if args.title:
-                annot_file.write('\n'.join(['\t'.join(['title', args.title]),
-                                            '\t'.join(['title_font_size', str(args.title_font_size)]), '\n']))
-
-            # write some basic customizations
-            annot_file.write('\n'.join(['\t'.join(['clade_separation', '0.5']),
-                                        '\t'.join(['branch_bracket_depth', '0.8']),
-                                        '\t'.join(['branch_bracket_width', '0.2']),
-                                        '\t'.join(['annotation_legend_font_size', str(args.annotation_legend_font_size)]),
-                                        '\t'.join(['class_legend_font_size', '10']),
-                                        '\t'.join(['class_legend_marker_size', '1.5']), '\n']))
-
-            # write the biomarkers' legend
-            for bk in biomarkers:
-                biom = pre_taxa.sub('', bk).replace('_', ' ').upper() # remove '{k|p|c|o|f|g|s|t}__'
-                # print biom,
-                rgb = scale_color(colors[color[bk]])
-                # print rgb
-                annot_file.write('\n'.join(['\t'.join([biom, 'annotation', biom]),
-                                            '\t'.join([biom, 'clade_marker_color', rgb]),
-                                            '\t'.join([biom, 'clade_marker_size', '40']), '\n']))
-
-            # write the annotation for the tree
-            for taxonomy in taxa:
-                level = taxonomy.count('.') + 1 # which level is this taxonomy?
-                clean_taxonomy = taxonomy[taxonomy.rfind('.') + 1:] # retrieve the last level in taxonomy
-                cleanest_taxonomy = pre_taxa.sub('', clean_taxonomy).replace('_', ' ') # remove '{k|p|c|o|f|g|s|t}__' and substitute '_' with ' '
-                scaled = args.def_clade_size
-
-                # scaled the size of the clade by the average abundance
-                if (taxonomy in abundances) or (taxonomy.replace('.', '|') in abundances):
-                    try:
-                        abu = abundances[taxonomy.replace('.', '|')]
-                    except:
-                        abu = abundances[taxonomy]
-
-                    scaled = scale_clade_size(args.min_clade_size, args.max_clade_size, abu, max_abundances)
-
-                annot_file.write(''.join(['\t'.join([clean_taxonomy, 'clade_marker_size', str(scaled)]), '\n']))
-
-                # put a bakcground annotation to the levels specified by the user
-                shaded_background = []
-
-                for l in background_list:
-                    if level >= l:
-                        lst = [s.strip() for s in taxonomy.strip().split('.')]
-                        t = '.'.join(lst[:l])
-
-                        if t not in shaded_background:
-                            shaded_background.append(t)
-
-                            font_size = args.min_font_size + ((args.max_font_size - args.min_font_size) / l)
-
-                            annot_file.write('\n'.join(['\t'.join([t, 'annotation_background_color', scale_color(colors[0])]),
-                                                        '\t'.join([t, 'annotation', pre_taxa.sub('', t).replace('_', ' ')]), # remove '{k|p|c|o|f|g|s|t}__' and substitute '_' with ' '
-                                                        '\t'.join([t, 'annotation_font_size', str(font_size)]), '\n']))
-
-                # put a bakcground annotation to the clades specified by the user
-                for c in background_colors:
-                    bg_color = background_colors[c]
-
-                    if not bg_color.startswith('#'):
-                        bg_color = bg_color.replace('(', '').replace(')', '')
-                        h, s, v = bg_color.split(';')
-                        bg_color = scale_color((float(h.strip()) , float(s.strip()), float(v.strip())))
-
-                    # check if the taxonomy has more than one level
-                    lvls = [str(cc.strip()) for cc in c.split('.')]
-                    done_clades = []
-
-                    for l in lvls:
-                        if (l in taxonomy) and (l not in done_clades):
-                            lvl = taxonomy[:taxonomy.index(l)].count('.') + 1
-                            font_size = args.min_font_size + ((args.max_font_size - args.min_font_size) / lvl)
-
-                            annot_file.write('\n'.join(['\t'.join([l, 'annotation_background_color', bg_color]),
-                                                        '\t'.join([l, 'annotation', pre_taxa.sub('', l).replace('_', ' ')]), # remove '{k|p|c|o|f|g|s|t}__' and substitute '_' with ' '
-                                                        '\t'.join([l, 'annotation_font_size', str(font_size)]), '\n']))
-
-                            done_clades.append(l)
-
-                if lefse_output:
-                    if taxonomy in lefse_output:
-                        es, bk, _, _ = lefse_output[taxonomy]
-
-                        # if it is a biomarker then color and label it!
-                        if bk:
-                            fac = log10(1. + 9. * (float(es) / max_effect_size))
-
-                            try:
-                                rgbs = scale_color(colors[color[bk]], fac)
-                            except Exception as e:
-                                print 'Exception:', e
-                                print ' '.join(["[W] Assign to", taxonomy, "the default color:", colors[color[bk]]])
-                                rgbs = colors[color[bk]]
-
-                            annot_file.write(''.join(['\t'.join([clean_taxonomy, 'clade_marker_color', rgbs]), '\n']))
-
-                            # write the annotation only if the abundance is above a given threshold and it is either internal or external annotation lists
-                            if (scaled >= args.abundance_threshold) and \
-                               ((level in annotations_list) or (level in external_annotations_list)):
-                                font_size = args.min_font_size + ((args.max_font_size - args.min_font_size) / level)
-                                annotation = cleanest_taxonomy if level in annotations_list else '*:' + cleanest_taxonomy
-
-                                annot_file.write('\n'.join(['\t'.join([clean_taxonomy, 'annotation_background_color', rgbs]),
-                                                            '\t'.join([clean_taxonomy, 'annotation', annotation]),
-                                                            '\t'.join([clean_taxonomy, 'annotation_font_size', str(font_size)]), '\n']))
-    except Exception as e:
-        print 'Exception:', e
+        for node in tree.add(f).lineage():
+            if node not in clades:
+                clades[node] = len(clades)
+
+            lineage.append(clades[node])
+
+        lineages.append(lineage)
+
+    depth = max([len(l) for l in lineages])
+    ancestors = np.array([l + [-1] * (depth - len(l)) for l in lineages], dtype=int)
+    values = np.array([[sum(ff[f])] if summ else ff[f] for f in feats], dtype=float)
+    sums = np.zeros((len(clades), values.shape[1]))
+
+    # accumulate the rows level by level, each clade gets its leaves in input order
+    for d in range(depth):
+        rows = np.flatnonzero(ancestors[:, d] >= 0)
+        np.add.at(sums, ancestors[rows, d], values[rows])
+
+    return dict([(node.taxonomy, sums[i].tolist()) for node, i in clades.iteritems()])
+
+
+def get_most_abundant(abundances, xxx):
+    """
+    Select, by abundance level, among all the taxonomy that represent at least two levels.
+    Return the first ``xxx`` most abundant, sorted as in a reverse sort of the (abundance, taxonomy) tuples.
+    """
+    return nlargest(xxx, ((float(abundances[a]), a.replace('|', '.')) for a in abundances
+                          if ('|' in a) or ('.' in a)))
+
+
+def get_biomarkes(abundant, xxx):
+    """
+    Split the taxonomy and then look, level by level, when there are at least ``xxx`` distinct branches.
+    Return the set of branches as biomarkers to highlight.
+    """
+    levels = []
+
+    # distinct branches of each level, collected in a single pass over the taxonomy
+    for _, t in abundant:
+        for lvl, c in enumerate(t.split('.')):
+            if lvl == len(levels):
+                levels.append(set())
+
+            levels[lvl].add(c)
+
+    old_bk = set()
+
+    for bk in levels:
+        if len(bk) >= xxx:
+            return bk
+
+        if len(old_bk) > len(bk):
+            return old_bk
+
+        old_bk = bk
+
+    return old_bk
+
+
+def scale_clade_size(minn, maxx, abu, max_abu):
+    """
+    Return the value of ``abu`` scaled to ``max_abu`` logarithmically, and then map from ``minn`` to ``maxx``.
+    """
+    return minn + (maxx-minn) * log10(1. + 9. * (abu/max_abu))
+
+
+def scale_clades(args, taxa, max_abu, max_effect_size, vectorized=True):
+    """
+    Compute in one batch over ``taxa`` the clade marker sizes, scaled by the average abundances as scale_clade_size()
+    does (the clades without abundance get ``--def_clade_size``), and the color factors of the biomarkers, scaled by
+    their effect sizes. If ``vectorized`` both are computed as NumPy arrays, otherwise one clade at a time, to not
+    import NumPy when the input matrix is not given.
+    Return the list of sizes and the list of factors (None for the clades that are not biomarkers).
+    """
+    abus = [clade.abundance for clade in taxa]
+    markers = [i for i, clade in enumerate(taxa) if clade.biomarker]
+    factors = [None] * len(taxa)
+
+    if not vectorized:
+        sizes = [scale_clade_size(args.min_clade_size, args.max_clade_size, abu, max_abu)
+                 if abu is not None else args.def_clade_size for abu in abus]
+
+        for i in markers:
+            factors[i] = log10(1. + 9. * (taxa[i].effect_size / max_effect_size))
+
+        return sizes, factors
+
+    import numpy as np
+
+    sizes = np.empty(len(taxa))
+    sizes.fill(args.def_clade_size)
+    present = [i for i, abu in enumerate(abus) if abu is not None]
+
+    if present:
+        values = np.array([abus[i] for i in present], dtype=float)
+        sizes[present] = args.min_clade_size + (args.max_clade_size - args.min_clade_size) * \
+                         np.log10(1. + 9. * (values / max_abu))
+
+    if markers:
+        effect_sizes = np.array([taxa[i].effect_size for i in markers], dtype=float)
+
+        for i, fac in zip(markers, np.log10(1. + 9. * (effect_sizes / max_effect_size)).tolist()):
+            factors[i] = fac
+
+    return sizes.tolist(), factors
+
+
+def read_matrix_rows(args):
+    """
+    Read the ``lefse_input`` tab-separated file one row at a time, parsing it as hclust2's DataMatrix does: the rows in
+    ``--skip_rows``, the blank and the commented (#) lines are skipped, the ``--fname_row`` row is the header, the
+    first column holds the feature names, and missing values are replaced with ``--def_na``.
+    Yield the (feature name, list of values) tuples.
+    """
+    toskip = set([int(l) for l in args.skip_rows.split(',')]) if args.skip_rows else set()
+    header = args.fname_row
+    ncols = None
+    drop = None
+
+    with open(args.lefse_input, 'r') as f:
+        for i, line in enumerate(f):
+            line = line[:line.find('#')] if '#' in line else line
+            line = line.rstrip('\r\n')
+
+            if (i in toskip) or (not line.strip()):
+                continue
+
+            row = line.split(args.sep)
+
+            if header > 0:  # rows before the header are discarded
+                header -= 1
+                continue
+            elif header == 0:
+                header = -1
+                ncols = len(row)
+                drop = row.index('NCBI_tax_id') if 'NCBI_tax_id' in row else None
+                continue
+
+            row = row[:ncols] if ncols else row
+            values = []
+
+            for j, v in enumerate(row[1:], 1):
+                if j == drop:
+                    continue
+
+                try:
+                    value = float(v)
+                except ValueError:
+                    value = float('nan')
+
+                # as DataMatrix's fillna(), also the literal nan values are replaced
+                values.append(args.def_na if (value != value) and (args.def_na is not None) else value)
+
+            yield row[0], values
+
+
+def select_features(rows, perc=90, top=None):
+    """
+    Compute the average of each row, and keep only the ``top`` rows with the highest ``perc`` percentile (as the
+    ``--ftop`` and ``--fperc`` params of hclust2's DataMatrix do). Only the selected rows are kept in memory: a bounded
+    heap holds the best ``top`` rows, and ``ties`` the rows equal to the worst of them. A ``top`` of 0 (or less) keeps
+    all the rows, as hclust2 does for ``--ftop 0``.
+    Return the list of selected feature names, in input order, and the dict of their average abundances.
+    """
+    import numpy as np
+
+    if (top is not None) and (top <= 0):
+        top = None
+
+    if top is not None:
+        from scipy.stats import scoreatpercentile
+
+    heap = []
+    ties = []
+    count = 0
+
+    for i, (name, values) in enumerate(rows):
+        values = np.array(values, dtype=float)
+        avg = np.nanmean(values) if len(values) else float('nan')
+        count += 1
+
+        if top is None:
+            heap.append((None, i, name, avg))
+            continue
+
+        item = (scoreatpercentile(values, perc), i, name, avg)
+
+        if len(heap) < top:
+            heappush(heap, item)
+        elif item[0] > heap[0][0]:
+            item = heapreplace(heap, item)
+
+            if item[0] < heap[0][0]: # the worst kept row increased, drop the rows tied with the previous one
+                ties = []
+            else:
+                ties.append(item)
+        elif item[0] == heap[0][0]:
+            ties.append(item)
+
+    if (top is not None) and (top > count):
+        print 'W ftop param value (' + str(top) + ') out of bound (len:' + str(count) + '). Selecting all the values from input.'
+
+    selected = sorted(heap + ties, key=lambda x: x[1])
+    return [name for _, _, name, _ in selected], dict([(name, avg) for _, _, name, avg in selected])
+
+
+def stream_lefse_input(args, profiler=None):
+    """
+    Load the tab-separated ``lefse_input`` one row at a time, applying the ``--ftop`` selection while reading, without
+    holding the whole matrix. The internal levels, if requested, are summed-up on a sparse matrix of all the rows.
+    Return the list of feature names and the dict of their average abundances.
+    """
+    profiler = profiler if profiler is not None else Profiler()
+
+    if args.internal_levels:  # the internal levels need all the rows, kept sparse
+        import numpy as np
+
+        feats, matrix = read_sparse_matrix(args)
+        profiler.stage('add_missing_levels')
+        feats, matrix = sum_internal_levels(feats, matrix)
+        profiler.stage('features selection')
+
+        if args.ftop > 0:
+            mask = select_top(matrix, args.fperc, args.ftop)
+            feats = [f for f, m in zip(feats, mask) if m]
+            matrix = matrix[np.flatnonzero(mask)]
+
+        return feats, dict(zip(feats, sparse_nanmean(matrix)))
+
+    return select_features(read_matrix_rows(args), args.fperc, args.ftop or None)
+
+
+def read_lefse_input(args, profiler=None):
+    """
+    Load the ``lefse_input`` file (either in BIOM or in tab-separated format) applying the DataMatrix params and, if
+    requested, adding the internal levels. The stages are recorded in ``profiler``, if given.
+    Return the list of feature names and the dict of their average abundances.
+    """
+    # if the lefse_input is in biom format, convert it
+    if get_file_type(args.lefse_input) in 'biom':
+        return parse_biom(args.lefse_input, args.discard_otus, args.internal_levels, args, profiler)
+
+    profiler = profiler if profiler is not None else Profiler()
+    profiler.stage('lefse_input parsing')
+
+    # the samples selection and the metadata rows need the whole matrix
+    if (not args.stop) and (not args.metadata_rows) and (args.sname_row == 0):
+        return stream_lefse_input(args, profiler)
+
+    from hclust2 import DataMatrix
+
+    if args.internal_levels:
+        aaa = {}
+        header = None
+        with open(args.lefse_input, 'r') as f:
+            for r in f:
+                if header is None:
+                    header = [s.strip() for s in r.split('\t')]
+                else:
+                    row = r.split('\t')
+                    aaa[row[0].strip().replace('|', '.')] = [float(s.strip()) for s in row[1:]]
+
+        profiler.stage('add_missing_levels')
+        feats = add_missing_levels(aaa, summ=False)
+        profiler.stage('lefse_input parsing')
+        ss = '\t'.join(header) + '\n'
+        ss += '\n'.join(['\t'.join([str(s) for s in [k] + feats[k]]) for k in feats])
+        lefse_input = DataMatrix(StringIO(ss), args)
+    else:
+        lefse_input = DataMatrix(args.lefse_input, args)
+
+    return lefse_input.get_fnames(), dict(lefse_input.get_averages())
+
+
+def to_float(value):
+    """
+    Return ``value`` as a float, NaN if it is missing or it is not a number (e.g., the '-' p-value of LEfSe).
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float('nan')
+
+
+# the missing values of the LEfSe output, mapped to a string that float() accepts
+MISSING_VALUES = {'': 'nan', '-': 'nan'}
+
+
+def to_floats(values):
+    """
+    Return the list of ``values`` as floats, as to_float() does for each of them, converting all of them at once.
+    """
+    try:
+        return map(float, map(MISSING_VALUES.get, values, values))
+    except ValueError:
+        return map(to_float, values)
+
+
+class LefseOutput(object):
+    """
+    Column-wise store of the LEfSe results. The features are indexed by their id, in input order, and their mean,
+    effect size and p-value are kept in float64 arrays (NaN when missing). The class names are interned in ``classes``
+    and each feature holds the code of its class, where the code 0 (the empty class) marks the features that are not
+    biomarkers.
+    """
+    def __init__(self):
+        self.taxa = []
+        self.index = {}
+        self.mean = array('d')
+        self.effect_size = array('d')
+        self.pvalue = array('d')
+        self.codes = array('i')
+        self.classes = ['']
+        self.class_codes = {'': 0}
+
+    @classmethod
+    def from_dict(cls, records):
+        """
+        Return the LefseOutput of the dict that maps each feature to its (effect size, biomarker, mean, p-value) tuple.
+        """
+        lefse_output = cls()
+
+        for t, (es, bk, m, pv) in records.iteritems():
+            lefse_output.add(t, es, bk, m, pv)
+
+        return lefse_output
+
+    def add(self, taxon, es, bk, m, pv):
+        """
+        Add (or replace) the results of ``taxon``, given either as strings or as numbers.
+        """
+        bk = bk if bk else ''
+
+        if bk not in self.class_codes:
+            self.class_codes[bk] = len(self.classes)
+            self.classes.append(bk)
+
+        record = (to_float(m), to_float(es), to_float(pv), self.class_codes[bk])
+
+        if taxon in self.index:
+            i = self.index[taxon]
+            self.mean[i], self.effect_size[i], self.pvalue[i], self.codes[i] = record
+        else:
+            self.index[taxon] = len(self.taxa)
+            self.taxa.append(taxon)
+            self.mean.append(record[0])
+            self.effect_size.append(record[1])
+            self.pvalue.append(record[2])
+            self.codes.append(record[3])
+
+    def extend(self, taxa, means, bks, effect_sizes, pvalues):
+        """
+        Append the results of ``taxa``, given as columns of strings, decoding each column at once. Unlike add(), the
+        ``taxa`` are expected to be distinct and not already present (see read_lefse_output()).
+        """
+        for bk in sorted(set(bks) - set(self.class_codes), key=bks.index):  # in order of appearance
+            self.class_codes[bk] = len(self.classes)
+            self.classes.append(bk)
+
+        self.index.update(izip(taxa, xrange(len(self.taxa), len(self.taxa) + len(taxa))))
+        self.taxa.extend(taxa)
+        self.mean.extend(to_floats(means))
+        self.effect_size.extend(to_floats(effect_sizes))
+        self.pvalue.extend(to_floats(pvalues))
+        self.codes.extend(map(self.class_codes.__getitem__, bks))
+
+    def biomarkers(self):
+        """
+        Return the set of the distinct biomarker classes.
+        """
+        return set([self.classes[c] for c in set(self.codes) if c])
+
+    def __getitem__(self, taxon):
+        """
+        Return the (effect size, biomarker, mean, p-value) tuple of ``taxon``.
+        """
+        i = self.index[taxon]
+        return self.effect_size[i], self.classes[self.codes[i]], self.mean[i], self.pvalue[i]
+
+    def __iter__(self):
+        return iter(self.taxa)
+
+    def __len__(self):
+        return len(self.taxa)
+
+    def __contains__(self, taxon):
+        return taxon in self.index
+
+
+def read_lefse_output(filename, block_size=1 << 24):
+    """
+    Load the LEfSe output file, memory-mapped and parsed in blocks of about ``block_size`` bytes: the fields of all the
+    rows of a block are split at once, and each column is decoded in bulk. Files with malformed rows, or that list a
+    feature more than once, are parsed row by row by read_lefse_output_rows().
+    Return the LefseOutput with the results of each feature.
+    """
+    lefse_output = LefseOutput()
+
+    with open(filename, 'r') as out_file:
+        if not os.fstat(out_file.fileno()).st_size:  # an empty file cannot be mapped
+            return lefse_output
+
+        data = mmap.mmap(out_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            start = 0
+
+            while start < len(data):
+                end = data.find('\n', start + block_size)
+                end = len(data) if end < 0 else end + 1
+                columns = split_lefse_block(data[start:end])
+
+                if columns is None:
+                    return read_lefse_output_rows(filename)
+
+                lefse_output.extend(*columns)
+                start = end
+        finally:
+            data.close()
+
+    if len(lefse_output.index) < len(lefse_output.taxa):  # repeated features, the last results replace the previous
+        return read_lefse_output_rows(filename)
+
+    return lefse_output
+
+
+def split_lefse_block(block):
+    """
+    Split the rows of the LEfSe output in ``block`` in their five fields.
+    Return the lists of the features, means, classes, effect sizes and p-values, or None if any row does not have
+    exactly five fields, or if it has leading or trailing whitespace that read_lefse_output_rows() would strip.
+    """
+    if ('\r' in block) or block[:1].isspace() or ('\n ' in block) or ('\n\t' in block):
+        return None
+
+    rows = block.split('\n')
+
+    if not rows[-1]:  # the block ends with a newline
+        rows.pop()
+
+    if map(str.count, rows, ['\t'] * len(rows)).count(4) < len(rows):
+        return None
+
+    fields = '\t'.join(rows).split('\t')
+
+    if '' in fields[4::5]:  # the p-value is stripped with the trailing tab
+        return None
+
+    return fields[0::5], fields[1::5], fields[2::5], fields[3::5], fields[4::5]
+
+
+def read_lefse_output_rows(filename):
+    """
+    Load the LEfSe output file one row at a time.
+    Return the LefseOutput with the results of each feature.
+    """
+    lefse_output = LefseOutput()
+
+    with open(filename, 'r') as out_file:
+        for line in out_file:
+            t, m, bk, es, pv = line.strip().split('\t')
+            lefse_output.add(t, es, bk, m, pv)
+
+    return lefse_output
+
+
+def hash_file(filename, digest=None):
+    """
+    Feed the content of ``filename`` to ``digest``, a new sha1 if not given.
+    Return the digest.
+    """
+    digest = digest if digest is not None else sha1()
+
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+
+    return digest
+
+
+class InputCache(object):
+    """
+    On-disk cache of the parsed ``lefse_input``: the feature names (a text file, one name per line) and their average
+    abundances (a .npy array, loaded memory-mapped). Entries are keyed by the content of the input file and by the
+    params that affect its parsing, and the least recently used entries are removed when the cache grows over
+    ``max_size`` MB.
+    """
+    PARAMS = ['discard_otus', 'internal_levels', 'sep', 'fname_row', 'sname_row', 'metadata_rows', 'skip_rows',
+              'sperc', 'fperc', 'stop', 'ftop', 'def_na']
+
+    def __init__(self, cache_dir, max_size=1024):
+        self.cache_dir = cache_dir
+        self.max_size = max_size * 1024 * 1024
+
+        try:
+            os.makedirs(cache_dir)
+        except OSError:  # already there (maybe created by another process), or not writable: read() parses the input
+            pass
+
+    def key(self, args):
+        """
+        Return the hash of the ``lefse_input`` content together with the parsing params and the version.
+        """
+        digest = hash_file(args.lefse_input)
+        digest.update(repr([__version__, get_file_type(args.lefse_input)] +
+                           [getattr(args, p, None) for p in self.PARAMS]))
+        return digest.hexdigest()
+
+    def read(self, args, profiler=None):
+        """
+        Return the feature names and the dict of their average abundances from the cache, loading ``lefse_input``
+        with read_lefse_input() and storing it in the cache if missing. The cache is best-effort: when an entry cannot
+        be read or written the input is parsed as without the cache.
+        """
+        import numpy as np
+
+        key = self.key(args)
+        names_file = os.path.join(self.cache_dir, key + '.txt')
+        averages_file = os.path.join(self.cache_dir, key + '.npy')
+        hit = False
+
+        if os.path.isfile(names_file) and os.path.isfile(averages_file):
+            try:
+                with open(names_file, 'r') as f:
+                    fnames = [n.rstrip('\n') for n in f]
+
+                values = np.load(averages_file, mmap_mode='r').tolist()
+
+                if len(values) != len(fnames):
+                    raise ValueError('the entry ' + key + ' has ' + str(len(fnames)) + ' names and ' +
+                                     str(len(values)) + ' averages')
+
+                averages = dict(zip(fnames, values))
+                hit = True
+
+                for f in [names_file, averages_file]:
+                    os.utime(f, None)  # mark as recently used
+            except (IOError, OSError, ValueError) as e:
+                if not hit:
+                    print ' '.join(["[W] Cannot read the cache entry, parsing lefse_input:", str(e)])
+
+        if not hit:
+            fnames, averages = read_lefse_input(args, profiler)
+
+            if profiler is not None:
+                profiler.stage('lefse_input cache')
+
+            try:
+                self.write(averages_file, lambda f: np.save(f, np.array([averages[n] for n in fnames], dtype=float)))
+                self.write(names_file, lambda f: f.write(''.join([n + '\n' for n in fnames])))
+                self.evict()
+            except (IOError, OSError) as e:
+                print ' '.join(["[W] Cannot write the cache entry:", str(e)])
+
+        hits, misses = self.count(hit)
+        print ' '.join(["[i] Cache", "hit" if hit else "miss", "(" + str(hits), "hits,", str(misses), "misses)"])
+        return fnames, averages
+
+    def write(self, filename, save):
+        """
+        Write ``filename`` atomically: ``save`` writes the content to a temporary file with a unique name in the cache
+        folder, which is then renamed, so that concurrent processes sharing the cache never see a partial file.
+        """
+        fd, tmp_file = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                save(f)
+
+            os.rename(tmp_file, filename)
+        except:
+            if os.path.isfile(tmp_file):
+                os.remove(tmp_file)
+
+            raise
+
+    def count(self, hit):
+        """
+        Update the hits and misses counters stored in the cache directory. The counters are best-effort: a missing or
+        unreadable file restarts them, and the updates of concurrent processes may be lost.
+        Return the updated counters.
+        """
+        stats_file = os.path.join(self.cache_dir, 'stats')
+        hits, misses = 0, 0
+
+        try:
+            with open(stats_file, 'r') as f:
+                hits, misses = [int(i) for i in f.read().split()]
+        except (IOError, ValueError):
+            pass
+
+        hits, misses = (hits + 1, misses) if hit else (hits, misses + 1)
+
+        try:
+            self.write(stats_file, lambda f: f.write(' '.join([str(hits), str(misses)])))
+        except (IOError, OSError):
+            pass
+
+        return hits, misses
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache is not larger than ``max_size``.
+        """
+        entries = {}
+
+        for f in os.listdir(self.cache_dir):
+            if get_file_type(f) in ['txt', 'npy']:
+                path = os.path.join(self.cache_dir, f)
+                key = f[:f.rfind('.')]
+                used, size = entries.get(key, (0., 0))
+                entries[key] = (max(used, os.path.getmtime(path)), size + os.path.getsize(path))
+
+        total = sum([size for _, size in entries.itervalues()])
+
+        for key in sorted(entries, key=lambda k: entries[k][0]):
+            if total <= self.max_size:
+                break
+
+            for ext in ['.txt', '.npy']:
+                if os.path.isfile(os.path.join(self.cache_dir, key + ext)):
+                    os.remove(os.path.join(self.cache_dir, key + ext))
+
+            total -= entries[key][1]
+
+
+# params that do not change the content of the outputs
+INCREMENTAL_SKIP = ['tree', 'annotation', 'buffer_size', 'profile', 'profile_file', 'cache_dir', 'cache_size',
+                    'incremental', 'annotation_workers']
+
+
+def conversion_state(args):
+    """
+    Return the dict that identifies a conversion: the version, the params that affect the outputs, and the hashes of
+    the files they point to (the inputs and the mapping files).
+    """
+    params = dict([(p, v) for p, v in vars(args).iteritems() if p not in INCREMENTAL_SKIP])
+    inputs = dict([(p, hash_file(v).hexdigest()) for p, v in params.iteritems()
+                   if isinstance(v, basestring) and os.path.isfile(v)])
+
+    return {'version': __version__, 'params': params, 'inputs': inputs}
+
+
+def is_up_to_date(manifest, state, outputs):
+    """
+    Return True if ``manifest`` records the same conversion ``state`` and the ``outputs`` files are unchanged since
+    then, False otherwise.
+    """
+    if not os.path.isfile(manifest):
+        return False
+
+    try:
+        with open(manifest, 'r') as f:
+            recorded = json.load(f)
+    except ValueError:  # not a valid manifest, convert again
+        return False
+
+    if json.dumps(recorded.get('state'), sort_keys=True) != json.dumps(state, sort_keys=True):
+        return False
+
+    for o in outputs:
+        if (not os.path.isfile(o)) or (recorded.get('outputs', {}).get(o) != hash_file(o).hexdigest()):
+            return False
+
+    return True
+
+
+def write_manifest(manifest, state, outputs):
+    """
+    Save the conversion ``state`` and the hashes of the ``outputs`` files in ``manifest``.
+    """
+    with open(manifest + '.tmp', 'w') as f:
+        json.dump({'state': state, 'outputs': dict([(o, hash_file(o).hexdigest()) for o in outputs])}, f,
+                  indent=2, sort_keys=True)
+
+    os.rename(manifest + '.tmp', manifest)
+
+
+def read_annotation_params(args):
+    """
+    Parse the params that select the levels and the clades to annotate and their colors, reading the mapping files
+    they can point to.
+    Return a dict with the parsed values, that can be given to convert() to avoid parsing them again.
+    """
+    background_list = []
+    background_clades = []
+    background_colors = {}
+    annotations_list = []
+    external_annotations_list = []
+    biomarkers2colors = None
+
+    # get the levels that should be shaded
+    if args.background_levels:
+        background_list = [int(i.strip()) for i in args.background_levels.strip().split(',')]
+
+    # get the background_clades
+    if args.background_clades:
+        if get_file_type(args.background_clades) in ['txt']:
+            with open(args.background_clades, 'r') as f:
+                background_clades = [str(s.strip()) for s in f]
+        else: # it's a string in csv format
+            background_clades = [str(s.strip()) for s in args.background_clades.split(',')]
+
+    # read the set of colors to use for the background_clades
+    if args.background_colors:
+        col = []
+
+        if get_file_type(args.background_colors) in ['txt']: # it's a mapping file
+            background_colors = dict([tuple(a.strip().split('\t')) for a in open(args.background_colors, 'r')])
+            # with open(args.background_colors, 'r') as f:
+            #     col = [str(s.strip()) for s in f]
+        else: # it's a string in csv format
+            col = [c.strip() for c in args.background_colors.split(',')]
+
+        lst = {}
+        i = 0
+
+        if not background_colors:
+            for c in background_clades:
+                cc = c[:c.find('.')]
+
+                if cc not in lst:
+                    background_colors[c] = col[i % len(col)]
+                    lst[cc] = col[i % len(col)]
+                    i += 1
+                else:
+                    background_colors[c] = lst[cc]
+
+    # get the levels that will use the internal annotation
+    if args.annotations:
+        annotations_list = [int(i.strip()) for i in args.annotations.strip().split(',')]
+
+    # get the levels that will use the external legend annotation
+    if args.external_annotations:
+        external_annotations_list = [int(i.strip()) for i in args.external_annotations.strip().split(',')]
+
+    # check overlapping between internal and external annotations
+    if set(annotations_list) & set(external_annotations_list):
+        print '[W] Some annotation levels are present in both internal and external params. The shared levels has been removed from the internal list.'
+        annotations_list = list(set(annotations_list) - set(external_annotations_list))
+
+    # read the mapping from biomarkers to colors
+    if args.biomarkers2colors:
+        biomarkers2colors = []
+
+        if os.path.isfile(args.biomarkers2colors):  # there exists a mapping file from biomarkers to colors read it
+            with open(args.biomarkers2colors) as f:
+                for row in f:
+                    if not row.startswith('#'):
+                        bk = row.strip().split('\t')[0]
+                        cl = tuple([float(i.strip()) for i in row.strip().split('\t')[1].split(',')])
+                        biomarkers2colors.append((bk, cl))
+
+    return {'background_list': background_list,
+            'background_clades': background_clades,
+            'background_colors': background_colors,
+            'annotations_list': annotations_list,
+            'external_annotations_list': external_annotations_list,
+            'biomarkers2colors': biomarkers2colors}
+
+
+# params that cannot change across the variants of a sweep, as the inputs are parsed only once
+SWEEP_FIXED = ['lefse_input', 'lefse_output', 'sweep', 'incremental', 'cache_dir', 'cache_size', 'profile',
+               'profile_file'] + InputCache.PARAMS
+
+
+def variant_filename(filename, name):
+    """
+    Return ``filename`` with ``name`` inserted before its extension (before the one preceding .gz, if compressed).
+    """
+    root, ext = os.path.splitext(filename)
+
+    if ext == '.gz':
+        root, inner = os.path.splitext(root)
+        ext = inner + ext
+
+    return root + '.' + name + ext
+
+
+def read_sweep(args):
+    """
+    Read the variants listed in the ``--sweep`` file, each one made of the params in ``args`` updated with the options
+    of the variant, checking their options and parsing their annotation params (see read_annotation_params()), so that
+    an invalid variant is reported before the inputs are parsed.
+    Return the list of (variant name, checked arguments, parsed annotation params) tuples.
+    """
+    variants = []
+
+    with open(args.sweep, 'r') as f:
+        for i, line in enumerate(f):
+            if (not line.strip()) or line.startswith('#'):
+                continue
+
+            row = line.rstrip('\n').split('\t')
+            name = row[0].strip()
+            argv = ['--tree', variant_filename(args.tree, name), '--annotation', variant_filename(args.annotation, name)]
+            parser = params_parser()
+            parser.error = argv_error
+
+            try:
+                variant, unknown = parser.parse_known_args(argv + shlex.split(' '.join(row[1:])), namespace=copy(args))
+            except Exception as e:
+                raise Exception('[read_sweep()] Invalid options in line ' + str(i+1) + ': ' + str(e))
+
+            if unknown:
+                raise Exception('[read_sweep()] Unknown options in line ' + str(i+1) + ': ' + ' '.join(unknown))
+
+            changed = [p for p in SWEEP_FIXED if getattr(variant, p, None) != getattr(args, p, None)]
+
+            if changed:
+                raise Exception('[read_sweep()] The variant in line ' + str(i+1) + ' cannot change: ' +
+                                ', '.join(['--' + p for p in changed]))
+
+            try:
+                variant = check_params(variant)
+                params = read_annotation_params(variant)
+            except Exception as e:
+                raise Exception('[read_sweep()] Invalid variant in line ' + str(i+1) + ': ' + str(e))
+
+            variants.append((name, variant, params))
+
+    return variants
+
+
+# params used by prepare_conversion(), all the others only change how the prepared taxonomy is written
+PREPARE_PARAMS = ['most_abundant', 'least_biomarkers', 'biomarkers2colors']
+# params that select the taxa when only the LEfSe output is given
+LEFSE_ONLY_PARAMS = ['min_clade_size', 'max_clade_size', 'abundance_threshold']
+
+
+def convert(args, fnames=None, averages=None, lefse_output=None, params=None, tree_file=None, annot_file=None,
+            profiler=None, errors=None):
+    """
+    Convert the features (``fnames``) with their average abundances (``averages``, a dict) and/or the LEfSe results
+    (``lefse_output``, a LefseOutput as returned by read_lefse_output(), or a dict that maps each feature to its
+    (effect size, biomarker, mean, p-value) tuple) into the GraPhlAn tree and annotation, written as rows to
+    ``tree_file`` and ``annot_file``. No input file is read, except the mapping files in ``args`` when ``params`` is
+    not given. The only state shared between calls (and threads) is the memo of the module-level ``normalizer``, a
+    cache of the normalized names that may be cleared at any time without changing the results. The stages are
+    recorded in ``profiler``, if given. The errors while writing the annotation are appended to ``errors``, if given
+    (see write_conversion()).
+    Return the tree and annotation writers, by default in-memory RowWriter whose getvalue() returns the text.
+    """
+    params = params if params is not None else read_annotation_params(args)
+    prepared = prepare_conversion(args, fnames, averages, lefse_output, params, profiler)
+    return write_conversion(args, prepared, params, tree_file, annot_file, profiler, errors)
+
+
+def prepare_conversion(args, fnames=None, averages=None, lefse_output=None, params=None, profiler=None):
+    """
+    Build the taxonomy of the features and/or of the LEfSe results (see convert()), attach to each clade its abundance
+    and LEfSe results, and assign the colors to the biomarkers. Besides the inputs, only the PREPARE_PARAMS (and the
+    LEFSE_ONLY_PARAMS, when ``averages`` is not given) in ``args`` are used, so the result can be written with
+    write_conversion() for any value of the other params.
+    Return the dict of the prepared taxonomy.
+    """
+    # HSV
+    colors = [(245., 90., 100.), # blue
+              (125., 80., 80.), # green
+              (0., 80., 100.), # red
+              (195., 100., 100.), # cyan
+              (150., 100., 100.), # light green
+              (55., 100., 100.), # yellow
+              (280., 80., 88.)] # purple
+    color = {}
+    biomarkers = set()
+    tree = Taxonomy()
+    taxa = []
+    abundances = {}
+    max_abundances = None
+    max_effect_size = None
+    lin = averages is None
+    params = params if params is not None else read_annotation_params(args)
+    profiler = profiler if profiler is not None else Profiler()
+
+    if not lin:
+        profiler.stage('intermediate levels')
+        taxa = [tree.add(normalizer.taxonomy(t)) for t in fnames]  # build taxonomy tree, with all intermediate levels
+
+        # check for duplicate taxa entries
+        profiler.stage('duplicates check')
+
+        if len(taxa) != len(set(taxa)):
+            raise Exception("There are duplicate taxa entries, please check the input file!")
+
+        taxa = tree.sorted()
+
+        # check if there are abundances to extract
+        abundances = averages
+        tot_abu = sum([abundances[a] for a in abundances if not (isnan(abundances[a]) or isinf(abundances[a]))])
+
+        if tot_abu > 0:
+            max_abundances = max([abundances[x] for x in abundances])
+        else:
+            abundances = dict()
+            print "abundances: empty"
+
+    profiler.stage('biomarkers')
+
+    if isinstance(lefse_output, dict):
+        lefse_output = LefseOutput.from_dict(lefse_output)
+
+    if lefse_output:
+        # get distinct biomarkers and the max effect size
+        biomarkers = lefse_output.biomarkers()
+        max_effect_size = max([es for es in lefse_output.effect_size if not isnan(es)])
+
+        # no lefse_input file provided!
+        if (not taxa) and (not abundances): # build taxonomy list and abundaces map
+            max_abundances = max(lefse_output.mean)
+
+            # only the features above the threshold are added to the taxonomy and to the abundances map
+            for t, m in izip(lefse_output.taxa, lefse_output.mean):
+                if scale_clade_size(args.min_clade_size, args.max_clade_size, m, max_abundances) >= \
+                   args.abundance_threshold:
+                    abundances[t.replace('.', '|')] = m
+                    taxa.append(tree.add(normalizer.taxonomy(t)))
+    elif lin:  # no lefse_output and no lefse_input provided
+        raise Exception("You must provide at least one input file!")
+    elif lefse_output is None:  # no lefse_output provided and lefse_input correctly red
+        lefse_output = LefseOutput()
+
+        # find the xxx most abundant
+        abundant = get_most_abundant(abundances, args.most_abundant)
+        # print "abundant:", len(abundant), abundant
+
+        # find the taxonomy level with at least yyy distinct childs from the xxx most abundant
+        biomarkers = get_biomarkes(abundant, args.least_biomarkers)
+        # print "biomarkers:", len(biomarkers), biomarkers
+
+        # compose lefse_output variable
+        for _, t in abundant:
+            b = ''
+
+            for bk in sorted(biomarkers):
+                if bk in t:
+                    b = bk
+
+            lefse_output.add(t, 2., b, '', '')
+
+        max_effect_size = 2.  # It's not gonna work... Maybe now??!?
+
+    # attach the abundances and the LEfSe results to the clades
+    for clade in taxa:
+        clade.abundance = abundances.get(clade.taxonomy.replace('.', '|'), abundances.get(clade.taxonomy))
+        i = lefse_output.index.get(clade.taxonomy)
+
+        if i is not None:
+            clade.effect_size = lefse_output.effect_size[i]
+            clade.biomarker = lefse_output.classes[lefse_output.codes[i]]
+            clade.mean = lefse_output.mean[i]
+            clade.pvalue = lefse_output.pvalue[i]
+
+    profiler.stage('color assignment')
+
+    # for each biomarker assign it to a different color
+    if args.biomarkers2colors:
+        for bk, cl in params['biomarkers2colors']:
+            colors.append(cl)
+            color[bk] = colors.index(cl)
+    else:  # assign them automagically!
+        i = 0
+
+        for bk in sorted(biomarkers):
+            color[bk] = i % len(colors)
+            i += 1
+
+    # print "color:", color
+
+    return {'tree': tree, 'taxa': taxa, 'lefse_output': lefse_output, 'biomarkers': biomarkers, 'colors': colors,
+            'color': color, 'max_abundances': max_abundances, 'max_effect_size': max_effect_size, 'lin': lin}
+
+
+def write_conversion(args, prepared, params=None, tree_file=None, annot_file=None, profiler=None, errors=None):
+    """
+    Write the taxonomy ``prepared`` by prepare_conversion() as rows of the GraPhlAn tree (``tree_file``) and annotation
+    (``annot_file``), according to the params in ``args``, and to their parsed values in ``params``. An error while
+    writing the annotation is printed, leaving it incomplete, and appended to the list ``errors``, if given.
+    Return the tree and annotation writers, by default in-memory RowWriter whose getvalue() returns the text.
+    """
+    tree = prepared['tree']
+    taxa = prepared['taxa']
+    lefse_output = prepared['lefse_output']
+    biomarkers = prepared['biomarkers']
+    colors = prepared['colors']
+    color = prepared['color']
+    max_abundances = prepared['max_abundances']
+    max_effect_size = prepared['max_effect_size']
+    params = params if params is not None else read_annotation_params(args)
+    background_list = params['background_list']
+    background_colors = params['background_colors']
+    annotations_list = params['annotations_list']
+    external_annotations_list = params['external_annotations_list']
+    tree_file = tree_file if tree_file is not None else RowWriter()
+    annot_file = annot_file if annot_file is not None else RowWriter()
+    profiler = profiler if profiler is not None else Profiler()
+
+    # write the tree
+    profiler.stage('tree writing')
+
+    if args.leaf_paths:
+        paths = leaf_paths(taxa)
+
+        if rebuild_tree([clade.taxonomy for clade in paths]) != rebuild_tree([clade.taxonomy for clade in taxa]):
+            raise Exception('[write_conversion()] The tree rebuilt from the leaf paths differs from the whole tree')
+    else:
+        paths = taxa
+
+    for clade in paths:
+        tree_file.write([clade.taxonomy])
+
+    tree_file.flush()
+
+    # write the annotation
+    profiler.stage('annotation writing')
+
+    try:
+        # index the background clades: each of their levels is associated to the color of the last clade that lists it
+        background_index = {}
+        background_level_color = scale_color(colors[0])
+
+        for c in background_colors:
+            bg_color = background_colors[c]
+
+            if not bg_color.startswith('#'):
+                bg_color = bg_color.replace('(', '').replace(')', '')
+                h, s, v = bg_color.split(';')
+                bg_color = scale_color((float(h.strip()) , float(s.strip()), float(v.strip())))
+
+            for l in [str(cc.strip()) for cc in c.split('.')]:
+                background_index[l] = bg_color
+
+        # set the title
+        if args.title:
+            annot_file.write(['title', args.title],
+                             ['title_font_size', str(args.title_font_size)], [])
+
+        # write some basic customizations
+        annot_file.write(['clade_separation', '0.5'],
+                         ['branch_bracket_depth', '0.8'],
+                         ['branch_bracket_width', '0.2'],
+                         ['annotation_legend_font_size', str(args.annotation_legend_font_size)],
+                         ['class_legend_font_size', '10'],
+                         ['class_legend_marker_size', '1.5'], [])
+
+        # scaled the size of the clades by their average abundance, and the biomarkers colors by their effect size
+        sizes, factors = scale_clades(args, taxa, max_abundances, max_effect_size, vectorized=not prepared['lin'])
+        size_strs = [str(scaled) for scaled in sizes]
+        font_sizes = [str(args.min_font_size + ((args.max_font_size - args.min_font_size) / l)) if l else None
+                      for l in range(max([clade.level for clade in taxa] or [0]) + 1)]
+        default_size = None
+
+        if args.compact_annotation and sizes:
+            default_size = Counter(size_strs).most_common(1)[0][0]
+            annot_file.write(['*', 'clade_marker_size', default_size])
+
+        # write the biomarkers' legend
+        for bk in sorted(biomarkers):
+            biom = normalizer.label(bk).upper()
+            # print biom,
+            rgb = scale_color(colors[color[bk]])
+            # print rgb
+            annot_file.write([biom, 'annotation', biom],
+                             [biom, 'clade_marker_color', rgb],
+                             [biom, 'clade_marker_size', '40'], [])
+
+        # the background of a level or clade is written once, with the last clade of its subtree: the position of its
+        # last copy when it was repeated for each clade, so that it still overrides the biomarker lines of the clade
+        background_last = {}
+
+        if background_list or background_index:
+            for i, clade in enumerate(taxa):
+                for node in clade.lineage():
+                    if (node.level in background_list) or (node.name in background_index):
+                        background_last[node.taxonomy] = i
+
+        # write the annotation for the tree
+        context = {'taxa': taxa, 'sizes': sizes, 'size_strs': size_strs, 'factors': factors,
+                   'default_size': default_size, 'font_sizes': font_sizes, 'background_list': background_list,
+                   'background_index': background_index, 'background_last': background_last,
+                   'background_level_color': background_level_color, 'annotations_list': annotations_list,
+                   'external_annotations_list': external_annotations_list, 'lefse_output': bool(lefse_output), 'colors': colors, 'color': color}
+        shards = shard_bounds(len(taxa), args.annotation_workers)
+
+        if len(shards) > 1:
+            skipped_lines, shaded = merge_shards(annotate_shards(args, context, shards), annot_file)
+            profiler.count('annotation shards', len(shards))
+        else:
+            skipped_lines, shaded = annotate_taxa(args, context, 0, len(taxa), annot_file)
+
+        annot_file.flush()
+        profiler.stop()
+        profiler.count('clades', len(tree))
+        profiler.count('taxa', len(taxa))
+        profiler.count('biomarkers', len(biomarkers))
+        profiler.count('background clades', shaded)
+        profiler.count('tree lines', tree_file.lines)
+        profiler.count('annotation lines', annot_file.lines)
+
+        if args.compact_annotation:
+            lines = annot_file.lines
+            print ' '.join(["[i] Annotation lines:", str(lines), "(" + str(lines + skipped_lines - 1), "without --compact_annotation)"])
+    except Exception as e:
+        print 'Exception:', e
+
+        if errors is not None:
+            errors.append('annotation: ' + str(e))
+
+    return tree_file, annot_file
+
+
+def leaf_paths(taxa):
+    """
+    Return the clades of ``taxa`` that have no descendant in ``taxa``, in the order that makes GraPhlAn rebuild from
+    their paths the same tree, with the children in the same order, that it rebuilds from the whole ``taxa``.
+    """
+    children = {}  # the children of each clade in order of first appearance, as GraPhlAn adds them
+    paths = []
+
+    for clade in taxa:
+        lineage = []
+        node = clade
+
+        while node.level and (node not in children):
+            lineage.append(node)
+            node = node.parent
+
+        for node in reversed(lineage):
+            children[node] = []
+            children.setdefault(node.parent if node.parent.level else None, []).append(node)  # None for the root
+
+    stack = children.get(None, [])[::-1]
+
+    while stack:
+        node = stack.pop()
+
+        if children[node]:
+            stack.extend(reversed(children[node]))
+        else:
+            paths.append(node)
+
+    return paths
+
+
+def rebuild_tree(paths):
+    """
+    Rebuild the tree from the dot-separated ``paths`` as GraPhlAn does, adding the missing clades of each path in turn.
+    Return the dict that maps each clade (and '' the root) to the list of its children, in order of appearance.
+    """
+    children = {'': []}
+
+    for path in paths:
+        parent = ''
+
+        for name in path.split('.'):
+            clade = parent + '.' + name if parent else name
+
+            if clade not in children:
+                children[clade] = []
+                children[parent].append(clade)
+
+            parent = clade
+
+    return children
+
+
+def annotate_taxa(args, context, start, end, annot_file):
+    """
+    Write to ``annot_file`` the annotation of the clades from ``start`` to ``end`` in ``context['taxa']``: their size,
+    their background and the one of their levels, and the color and label of the biomarkers. The background of each
+    level and clade is written once, with the last clade of its subtree (see ``context['background_last']``).
+    Return the number of size lines skipped by --compact_annotation, and the number of background blocks.
+    """
+    taxa = context['taxa']
+    sizes = context['sizes']
+    size_strs = context['size_strs']
+    factors = context['factors']
+    default_size = context['default_size']
+    font_sizes = context['font_sizes']
+    background_list = context['background_list']
+    background_index = context['background_index']
+    background_last = context['background_last']
+    background_level_color = context['background_level_color']
+    annotations_list = context['annotations_list']
+    external_annotations_list = context['external_annotations_list']
+    lefse_output = context['lefse_output']
+    colors = context['colors']
+    color = context['color']
+    marker_colors = {}  # scale_color() of each (biomarker, factor) pair
+    skipped_lines = 0
+    backgrounds = 0
+
+    for i in xrange(start, end):
+        clade = taxa[i]
+        scaled = sizes[i]
+        size_str = size_strs[i]
+        fac = factors[i]
+        taxonomy = clade.taxonomy
+        level = clade.level # which level is this taxonomy?
+        clean_taxonomy = clade.name # the last level in taxonomy
+
+        if size_str != default_size:
+            annot_file.write([clean_taxonomy, 'clade_marker_size', size_str])
+        else:
+            skipped_lines += 1
+
+        # put a background annotation to the levels and to the clades specified by the user, only once
+        if background_last:
+            for node in clade.lineage():
+                if background_last.get(node.taxonomy) != i:
+                    continue
+
+                if node.level in background_list:
+                    annot_file.write([node.taxonomy, 'annotation_background_color', background_level_color],
+                                     [node.taxonomy, 'annotation', normalizer.label(node.taxonomy)],
+                                     [node.taxonomy, 'annotation_font_size', font_sizes[node.level]], [])
+                    backgrounds += 1
+
+                if node.name in background_index:
+                    annot_file.write([node.name, 'annotation_background_color', background_index[node.name]],
+                                     [node.name, 'annotation', node.label],
+                                     [node.name, 'annotation_font_size', font_sizes[node.level]], [])
+                    backgrounds += 1
+
+        bk = clade.biomarker
+
+        # if it is a biomarker then color and label it!
+        if lefse_output and bk:
+            if (bk, fac) not in marker_colors:
+                try:
+                    marker_colors[(bk, fac)] = scale_color(colors[color[bk]], fac)
+                except Exception as e:
+                    print 'Exception:', e
+                    print ' '.join(["[W] Assign to", taxonomy, "the default color:", colors[color[bk]]])
+                    marker_colors[(bk, fac)] = colors[color[bk]]
+
+            rgbs = marker_colors[(bk, fac)]
+            annot_file.write([clean_taxonomy, 'clade_marker_color', rgbs])
+
+            # write the annotation only if the abundance is above a given threshold and it is either internal or external annotation lists
+            if (scaled >= args.abundance_threshold) and \
+               ((level in annotations_list) or (level in external_annotations_list)):
+                annotation = clade.label if level in annotations_list else '*:' + clade.label
+
+                annot_file.write([clean_taxonomy, 'annotation_background_color', rgbs],
+                                 [clean_taxonomy, 'annotation', annotation],
+                                 [clean_taxonomy, 'annotation_font_size', font_sizes[level]], [])
+
+    return skipped_lines, backgrounds
+
+
+def shard_bounds(n, workers, min_shard=1000):
+    """
+    Split ``n`` clades in shards of consecutive clades of about the same size, four for each of the ``workers`` to
+    balance their load, and none smaller than ``min_shard`` clades.
+    Return the list of (start, end) bounds of the shards.
+    """
+    shards = max(1, min(workers * 4, n // min_shard)) if workers > 1 else 1
+    return [(n * i // shards, n * (i + 1) // shards) for i in range(shards)]
+
+
+def shard_annotation(args, context, bounds):
+    """
+    Return the annotation text of the clades within ``bounds`` and its number of lines, the number of skipped lines,
+    and the number of background blocks.
+    """
+    shard = ShardWriter()
+    skipped_lines, backgrounds = annotate_taxa(args, context, bounds[0], bounds[1], shard)
+    text, lines = shard.getvalue()
+    return text, lines, skipped_lines, backgrounds
+
+
+# the (args, context) of the shards within a worker process of annotate_shards(), set when the worker starts
+_shard_context = None
+
+
+def init_shard_worker(args, context):
+    global _shard_context
+    _shard_context = (args, context)
+
+
+def annotate_shard(bounds):
+    args, context = _shard_context
+    return shard_annotation(args, context, bounds)
+
+
+def annotate_shards(args, context, shards):
+    """
+    Annotate the ``shards`` on a pool of ``args.annotation_workers`` processes, or serially within a worker process
+    (that cannot start its own pool), e.g., in export2graphlan_batch.py. Each call starts its own pool, that receives
+    ``args`` and ``context`` when its workers start, so concurrent calls do not share any state.
+    Return the list of the shard_annotation() results, in the order of the shards.
+    """
+    from multiprocessing import Pool, current_process
+
+    if current_process().daemon:
+        return [shard_annotation(args, context, bounds) for bounds in shards]
+
+    pool = Pool(min(args.annotation_workers, len(shards)), initializer=init_shard_worker, initargs=(args, context))
+
+    try:
+        return pool.map(annotate_shard, shards)
+    finally:
+        pool.terminate()
+
+
+def merge_shards(results, annot_file):
+    """
+    Write the annotation of the shards to ``annot_file`` in order, so that the annotation is the same as the one
+    written by a single annotate_taxa().
+    Return the number of size lines skipped by --compact_annotation, and the number of background blocks.
+    """
+    skipped_lines = 0
+    backgrounds = 0
+
+    for text, lines, skipped, shaded in results:
+        annot_file.write_text(text, lines)
+        skipped_lines += skipped
+        backgrounds += shaded
+
+    return skipped_lines, backgrounds
+
+
+def run(args, params=None, profiler=None):
+    """
+    Read the input files given in ``args``, and write the tree and the annotation files. The parsed annotation params
+    can be given with ``params``, see read_annotation_params(). The stages are recorded in ``profiler``, if given.
+    With ``--incremental`` the conversion is skipped when its inputs, params and outputs did not change since the
+    previous run. An error while reading ``lefse_input`` stops the conversion, one while writing the annotation is
+    printed and the conversion goes on without it. The previous tree and annotation files are replaced only when the
+    conversion succeeded.
+    Return the list of the latter errors, empty if the conversion succeeded.
+    """
+    fnames = None
+    averages = None
+    lefse_output = None
+    profiler = profiler if profiler is not None else Profiler()
+    manifest = None
+    errors = []
+
+    if args.incremental:
+        profiler.stage('incremental check')
+        manifest = args.annotation + '.manifest'
+        state = conversion_state(args)
+
+        if is_up_to_date(manifest, state, [args.tree, args.annotation]):
+            print ' '.join(["[i] Inputs and params unchanged since the last conversion, skipping", args.tree, "and",
+                            args.annotation])
+            return errors
+
+    if args.sweep:  # an invalid variant is reported before parsing the inputs
+        variants = read_sweep(args)
+
+    if args.lefse_input:
+        try:
+            if args.cache_dir:
+                profiler.stage('lefse_input cache')
+                fnames, averages = InputCache(args.cache_dir, args.cache_size).read(args, profiler)
+            else:
+                fnames, averages = read_lefse_input(args, profiler)
+
+            profiler.count('features', len(fnames))
+        except Exception as e:  # the conversion would go on without the abundances, and fail or differ
+            raise Exception('[run()] Cannot read the lefse_input ' + args.lefse_input + ': ' + str(e))
+
+    if args.lefse_output:
+        profiler.stage('lefse_output parsing')
+
+        # if the lefse_output is in biom format... I don't think it's possible!
+        if get_file_type(args.lefse_output) in 'biom':
+            lefse_output = LefseOutput()
+            print "Seriously?? LEfSe output file is not expected to be in biom format!"
+        else:
+            lefse_output = read_lefse_output(args.lefse_output)
+
+        profiler.count('lefse_output rows', len(lefse_output))
+
+    if args.sweep:
+        return errors + sweep(args, fnames, averages, lefse_output, profiler, variants)
+
+    # the outputs are written to temporary files, that replace the previous ones only if the conversion succeeded
+    with RowWriter(args.tree, args.buffer_size, atomic=True) as tree_file:
+        with RowWriter(args.annotation, args.buffer_size, atomic=True) as annot_file:
+            convert(args, fnames, averages, lefse_output, params, tree_file, annot_file, profiler, errors)
+
+    for output in [tree_file, annot_file]:
+        if errors:
+            output.discard()
+        else:
+            output.commit()
+
+    if manifest and (not errors):  # a failed conversion is redone by the next run
+        write_manifest(manifest, state, [args.tree, args.annotation])
+    elif manifest and os.path.isfile(manifest):
+        os.remove(manifest)
+
+    return errors
+
+
+def sweep(args, fnames=None, averages=None, lefse_output=None, profiler=None, variants=None):
+    """
+    Write the tree and the annotation files of each variant in the ``--sweep`` file (or of the ``variants`` already
+    returned by read_sweep()), from the same parsed inputs. The taxonomy is prepared once for all the variants that
+    share the params it depends on (see prepare_conversion()).
+    Return the list of the errors while writing the annotation of the variants, empty if all of them succeeded.
+    """
+    prepared = {}
+    errors = []
+    variants = variants if variants is not None else read_sweep(args)
+
+    for name, variant, params in variants:
+        key = tuple([getattr(variant, p) for p in PREPARE_PARAMS + (LEFSE_ONLY_PARAMS if averages is None else [])])
+
+        if key not in prepared:
+            prepared[key] = prepare_conversion(variant, fnames, averages, lefse_output, params, profiler)
+
+        failed = len(errors)
+
+        with RowWriter(variant.tree, variant.buffer_size, atomic=True) as tree_file:
+            with RowWriter(variant.annotation, variant.buffer_size, atomic=True) as annot_file:
+                write_conversion(variant, prepared[key], params, tree_file, annot_file, profiler, errors)
+
+        if len(errors) > failed:  # the previous outputs of the variant are left untouched
+            tree_file.discard()
+            annot_file.discard()
+            print ' '.join(["[e] Variant", name, "failed, not written"])
+            continue
+
+        tree_file.commit()
+        annot_file.commit()
+        print ' '.join(["[i] Variant", name, "written to", variant.tree, "and", variant.annotation])
+
+    print ' '.join(["[i]", str(len(variants)), "variants from", str(len(prepared)), "prepared taxonomies"])
+    return errors
+
+
+def main():
+    """
+    Command line wrapper around convert(): read the input files and write the tree and the annotation files.
+    """
+    args = read_params()
+    profiler = Profiler() if args.profile else None
+
+    try:
+        errors = run(args, profiler=profiler)
+    except Exception as e:
+        print e
+        exit(1)
+
+    if errors:  # already printed, the outputs were not written
+        exit(1)
+
+    if profiler is not None:
+        report = profiler.report(args.profile)
+
+        if args.profile_file:
+            with open(args.profile_file, 'w') as f:
+                f.write(report + '\n')
+        else:
+            print report
 
 
 if __name__ == '__main__':
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+
+import shlex
+from argparse import ArgumentParser
+from multiprocessing import Pool
+from timeit import default_timer
+import export2graphlan as e2g
+
+
+__author__ = e2g.__author__
+__email__ = e2g.__email__
+__version__ = e2g.__version__
+__date__ = e2g.__date__
+
+
+# params whose values are parsed by read_annotation_params(), possibly reading a mapping file
+SHARED_PARAMS = ['background_levels', 'background_clades', 'background_colors', 'annotations',
+                 'external_annotations', 'biomarkers2colors']
+
+
+def read_params():
+    """
+    Parse the input parameters.
+    Return the parsed arguments.
+    """
+    parser = ArgumentParser(description="export2graphlan_batch.py (ver. "+__version__+" of "+__date__+"). Run many "
+        "export2graphlan.py conversions listed in a manifest file on a pool of worker processes. Authors: "+
+        __author__+" ("+__email__+")")
+
+    parser.add_argument('manifest',
+        type=str,
+        help="Tab-separated file with one job per line and the columns: lefse_input, lefse_output, tree, annotation, "
+             "and (optional) the export2graphlan.py options of the job, e.g., \"--annotations 2,3 --title 'Study 1'\". "
+             "Use - for a missing input file. Lines starting with # are skipped")
+    parser.add_argument('-w', '--workers',
+        default=1,
+        type=int,
+        required=False,
+        help="Number of worker processes. Default is 1")
+    parser.add_argument('--options',
+        default='',
+        type=str,
+        required=False,
+        help="export2graphlan.py options shared by all the jobs, placed before the options of each job. Surround the "
+             "string with \", e.g., --options \"--background_colors colors.txt --biomarkers2colors biomarkers.txt\"")
+
+    return parser.parse_args()
+
+
+def read_manifest(filename, options=''):
+    """
+    Read the jobs listed in the manifest file, prepending the shared ``options`` to the options of each job.
+    Return the list of (job name, export2graphlan.py arguments) tuples.
+    """
+    jobs = []
+
+    with open(filename, 'r') as f:
+        for i, line in enumerate(f):
+            if (not line.strip()) or line.startswith('#'):
+                continue
+
+            row = line.rstrip('\n').split('\t')
+
+            if len(row) < 4:
+                raise Exception('[read_manifest()] Line ' + str(i+1) + ' has less than four columns')
+
+            lefse_input, lefse_output, tree, annotation = [c.strip() for c in row[:4]]
+            argv = shlex.split(options) + shlex.split(' '.join(row[4:]))
+
+            if lefse_input not in ['', '-']:
+                argv += ['--lefse_input', lefse_input]
+
+            if lefse_output not in ['', '-']:
+                argv += ['--lefse_output', lefse_output]
+
+            jobs.append((tree, argv + ['--tree', tree, '--annotation', annotation]))
+
+    return jobs
+
+
+def run_job(job):
+    """
+    Run a single conversion with the already parsed annotation params.
+    Return the wall time of the job and the error message (None if the job succeeded). A conversion that went on
+    after an error (e.g., writing its annotation) failed.
+    """
+    argv, params = job
+    start = default_timer()
+    error = None
+
+    try:
+        errors = e2g.run(e2g.read_params(argv), params)
+
+        if errors:
+            error = '; '.join(errors)
+    except SystemExit as e:  # e.g., --help, the argparse errors are raised as an Exception
+        error = 'exit while parsing the arguments (exit status ' + str(e.code) + ')'
+    except Exception as e:
+        error = str(e)
+
+    return default_timer() - start, error
+
+
+def main():
+    args = read_params()
+    jobs = read_manifest(args.manifest, args.options)
+    params = {}
+    todo = []
+    results = [(0., None)] * len(jobs)
+
+    # parse the shared inputs (e.g., the colors mapping files) only once for all the jobs that use them
+    for i, (_, argv) in enumerate(jobs):
+        try:
+            job_args = e2g.read_params(argv)
+            key = tuple([getattr(job_args, p) for p in SHARED_PARAMS])
+
+            if key not in params:
+                params[key] = e2g.read_annotation_params(job_args)
+
+            todo.append((i, (argv, params[key])))
+        except SystemExit as e:  # e.g., --help, the argparse errors are raised as an Exception
+            results[i] = (0., 'exit while parsing the arguments (exit status ' + str(e.code) + ')')
+        except Exception as e:
+            results[i] = (0., str(e))
+
+    start = default_timer()
+
+    if args.workers > 1:
+        pool = Pool(args.workers)
+        done = pool.map(run_job, [job for _, job in todo])
+        pool.close()
+        pool.join()
+    else:
+        done = [run_job(job) for _, job in todo]
+
+    wall_time = default_timer() - start
+
+    for (i, _), result in zip(todo, done):
+        results[i] = result
+
+    print '\t'.join(['job', 'time (s)', 'status'])
+
+    for (name, _), (seconds, error) in zip(jobs, results):
+        print '\t'.join([name, '{0:.3f}'.format(seconds), error if error else 'ok'])
+
+    failed = len([error for _, error in results if error])
+    print ' '.join(["[i]", str(len(jobs)), "jobs,", str(failed), "failed, in", '{0:.3f}'.format(wall_time), "s with",
+                    str(args.workers), "workers (" + '{0:.2f}'.format(len(jobs) / wall_time if wall_time else 0.),
+                    "jobs/s)"])
+
+    if failed:
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
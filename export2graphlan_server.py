@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+
+
+import os
+import json
+import math
+import stat
+import signal
+import socket
+import SocketServer
+import threading
+from argparse import ArgumentParser
+from collections import OrderedDict, deque
+from timeit import default_timer
+import export2graphlan as e2g
+
+
+__author__ = e2g.__author__
+__email__ = e2g.__email__
+__version__ = e2g.__version__
+__date__ = e2g.__date__
+
+
+def read_params():
+    """
+    Parse the input parameters.
+    Return the parsed arguments.
+    """
+    parser = ArgumentParser(description="export2graphlan_server.py (ver. "+__version__+" of "+__date__+"). Serve "
+        "export2graphlan.py conversions on a Unix domain socket or on a localhost TCP port, keeping the parsed input "
+        "files in memory between the jobs. Authors: "+__author__+" ("+__email__+")")
+
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('-s', '--socket',
+        type=str,
+        help="Path of the Unix domain socket to listen on")
+    group.add_argument('-p', '--port',
+        type=int,
+        help="TCP port to listen on")
+    parser.add_argument('--host',
+        default='127.0.0.1',
+        type=str,
+        required=False,
+        help="Address to bind when listening on a TCP port. Default is 127.0.0.1")
+    parser.add_argument('-w', '--workers',
+        default=4,
+        type=int,
+        required=False,
+        help="Number of conversions run concurrently, further jobs wait for a free worker. The workers are threads "
+             "sharing the cache of the parsed inputs: they overlap the reading of the files, but the conversions "
+             "themselves do not run in parallel. For parallel throughput run a server for each core. Default is 4")
+    parser.add_argument('--cache_entries',
+        default=32,
+        type=int,
+        required=False,
+        help="Maximum number of parsed input files kept in memory, the least recently used are dropped first. Default "
+             "is 32")
+    parser.add_argument('--latency_window',
+        default=1000,
+        type=int,
+        required=False,
+        help="Number of most recent jobs used for the latency percentiles of the statistics. Default is 1000")
+
+    args = parser.parse_args()
+
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+
+    return args
+
+
+class LRUCache(object):
+    """
+    Thread-safe in-memory cache that keeps at most ``max_entries`` values, dropping the least recently used first.
+    """
+    def __init__(self, max_entries=32):
+        self.max_entries = max(1, max_entries)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, load):
+        """
+        Return the value of ``key``, calling ``load()`` and storing its result if missing. The lock is not held while
+        loading, so the same missing key may be loaded by concurrent jobs.
+        """
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                value = self.entries.pop(key)
+                self.entries[key] = value  # mark as recently used
+                return value
+
+            self.misses += 1
+
+        value = load()
+
+        with self.lock:
+            self.entries[key] = value
+
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+        return value
+
+    def stats(self):
+        """
+        Return the dict of the number of entries, hits, misses, and the hit rate.
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self.entries), 'max_entries': self.max_entries, 'hits': self.hits,
+                    'misses': self.misses, 'hit_rate': float(self.hits) / lookups if lookups else 0.}
+
+
+def file_key(filename):
+    """
+    Return the absolute path of ``filename`` with its modification time and size, so that a cached entry is reloaded
+    when the file changes.
+    """
+    st = os.stat(filename)
+    return (os.path.abspath(filename), st.st_mtime, st.st_size)
+
+
+def percentile(values, perc):
+    """
+    Return the ``perc`` percentile (nearest rank) of the sorted ``values``.
+    """
+    if not values:
+        return 0.
+
+    return values[min(len(values) - 1, max(0, int(math.ceil(perc / 100. * len(values))) - 1))]
+
+
+def job_argv(job):
+    """
+    Return the export2graphlan.py arguments of ``job``: either its ``argv`` list, or its ``options`` dict mapping the
+    long option names to their values (True for the flags). Without --tree and --annotation the outputs are returned
+    in the response instead of written.
+    """
+    if 'argv' in job:
+        if not isinstance(job['argv'], list):
+            raise Exception('[job_argv()] "argv" must be a list of strings')
+
+        argv = [str(a) for a in job['argv']]
+    elif 'options' in job:
+        if not isinstance(job['options'], dict):
+            raise Exception('[job_argv()] "options" must be an object')
+
+        argv = []
+
+        for k, v in sorted(job['options'].iteritems()):
+            if v is True:
+                argv.append('--' + k)
+            elif (v is not False) and (v is not None):
+                argv += ['--' + k, str(v)]
+    else:
+        raise Exception('[job_argv()] The job must have either "argv" or "options"')
+
+    return ['--tree', '', '--annotation', ''] + argv
+
+
+class ConversionServer(object):
+    """
+    Runs the conversion jobs on at most ``workers`` threads at a time, sharing an LRUCache of the parsed inputs, and
+    collects the statistics of the served jobs.
+    """
+    def __init__(self, workers=4, cache_entries=32, latency_window=1000):
+        self.workers = workers
+        self.slots = threading.BoundedSemaphore(workers)
+        self.cache = LRUCache(cache_entries)
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=max(1, latency_window))
+        self.started = default_timer()
+        self.jobs = 0
+        self.errors = 0
+        self.running = 0
+        self.waiting = 0
+
+    def handle(self, request):
+        """
+        Serve a single request: a conversion job, or {"command": "stats"} for the statistics.
+        Return the response dict.
+        """
+        command = request.get('command', 'convert')
+
+        if command == 'stats':
+            return self.stats()
+
+        if command != 'convert':
+            return {'status': 'error', 'error': 'unknown command ' + repr(command)}
+
+        start = default_timer()  # the latency includes the wait for a free worker
+
+        with self.lock:
+            self.waiting += 1
+
+        with self.slots:
+            with self.lock:
+                self.waiting -= 1
+                self.running += 1
+
+            try:
+                response = self.convert(request)
+            except SystemExit as e:  # e.g., --help, the argparse errors are raised as an Exception
+                response = {'status': 'error', 'error': 'exit while parsing the arguments (exit status ' +
+                            str(e.code) + ')'}
+            except Exception as e:
+                response = {'status': 'error', 'error': str(e)}
+
+            seconds = default_timer() - start
+
+        with self.lock:
+            self.running -= 1
+            self.jobs += 1
+            self.errors += response['status'] == 'error'
+            self.latencies.append(seconds)
+
+        response['seconds'] = seconds
+        return response
+
+    def convert(self, job):
+        """
+        Run the conversion job, as run() does but reading the inputs through the in-memory cache.
+        Return the response dict, with the tree and annotation text if no output file was given.
+        """
+        args = e2g.read_params(job_argv(job))
+        fnames, averages, lefse_output = None, None, None
+
+        if bool(args.tree) != bool(args.annotation):
+            raise Exception('[convert()] Either both or none of --tree and --annotation must be given')
+
+        if args.sweep:
+            raise Exception('[convert()] --sweep is not supported by the server, send one job for each variant')
+
+        if args.annotation_workers > 1:  # forking a pool from the threads of the server is not safe
+            raise Exception('[convert()] --annotation_workers is not supported by the server, the jobs run on its '
+                            'workers')
+
+        if args.incremental and args.tree:
+            manifest = args.annotation + '.manifest'
+            state = e2g.conversion_state(args)
+
+            if e2g.is_up_to_date(manifest, state, [args.tree, args.annotation]):
+                return {'status': 'skipped'}
+
+        if args.lefse_input:
+            key = ('lefse_input',) + file_key(args.lefse_input) + \
+                  tuple([repr(getattr(args, p, None)) for p in e2g.InputCache.PARAMS])
+            fnames, averages = self.cache.get(key, lambda: e2g.read_lefse_input(args))
+
+        if args.lefse_output:
+            if e2g.get_file_type(args.lefse_output) in 'biom':
+                raise Exception('[convert()] LEfSe output file is not expected to be in biom format')
+
+            key = ('lefse_output',) + file_key(args.lefse_output)
+            lefse_output = self.cache.get(key, lambda: e2g.read_lefse_output(args.lefse_output))
+
+        errors = []
+
+        if not args.tree:
+            tree, annotation = e2g.convert(args, fnames, averages, lefse_output, errors=errors)
+
+            if errors:
+                raise Exception('; '.join(errors))
+
+            return {'status': 'ok', 'tree': tree.getvalue(), 'annotation': annotation.getvalue()}
+
+        with e2g.RowWriter(args.tree, args.buffer_size, atomic=True) as tree_file:
+            with e2g.RowWriter(args.annotation, args.buffer_size, atomic=True) as annot_file:
+                e2g.convert(args, fnames, averages, lefse_output, None, tree_file, annot_file, errors=errors)
+
+        if errors:  # the previous outputs are left untouched
+            tree_file.discard()
+            annot_file.discard()
+            raise Exception('; '.join(errors))
+
+        tree_file.commit()
+        annot_file.commit()
+
+        if args.incremental:
+            e2g.write_manifest(manifest, state, [args.tree, args.annotation])
+
+        return {'status': 'ok', 'tree': args.tree, 'annotation': args.annotation}
+
+    def stats(self):
+        """
+        Return the statistics dict: uptime, jobs served and failed, busy and waiting workers, cache hit rate, and the
+        latency percentiles (in milliseconds) of the most recent jobs.
+        """
+        with self.lock:
+            latencies = sorted(self.latencies)
+            stats = {'status': 'ok', 'version': __version__, 'uptime': default_timer() - self.started,
+                     'workers': self.workers, 'running': self.running, 'waiting': self.waiting, 'jobs': self.jobs,
+                     'errors': self.errors}
+
+        stats['cache'] = self.cache.stats()
+        stats['latency_ms'] = dict([('p' + str(p), percentile(latencies, p) * 1000.) for p in [50, 90, 99]] +
+                                   [('max', latencies[-1] * 1000. if latencies else 0.), ('window', len(latencies))])
+        return stats
+
+
+class RequestHandler(SocketServer.StreamRequestHandler):
+    """
+    Reads one JSON request per line and writes one JSON response per line, until the client closes the connection.
+    """
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            if not line.strip():
+                continue
+
+            try:
+                request = json.loads(line)
+
+                if not isinstance(request, dict):
+                    raise ValueError('the request must be a JSON object')
+            except ValueError as e:
+                response = {'status': 'error', 'error': 'invalid request: ' + str(e)}
+            else:
+                response = self.server.conversions.handle(request)
+
+            self.wfile.write(json.dumps(response) + '\n')
+            self.wfile.flush()
+
+
+class ThreadingUnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class ThreadingTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def send_request(address, request):
+    """
+    Send ``request`` (a dict) to the server listening on ``address``, a Unix socket path or a (host, port) tuple.
+    Return the response dict.
+    """
+    sock = socket.socket(socket.AF_UNIX if isinstance(address, basestring) else socket.AF_INET, socket.SOCK_STREAM)
+
+    try:
+        sock.connect(address)
+        f = sock.makefile('r+b')
+        f.write(json.dumps(request) + '\n')
+        f.flush()
+        response = f.readline()
+        f.close()
+    finally:
+        sock.close()
+
+    if not response:
+        raise Exception('[send_request()] The server closed the connection without a response')
+
+    return json.loads(response)
+
+
+def main():
+    args = read_params()
+
+    if args.socket:
+        if os.path.exists(args.socket):  # left by a previous server, but never remove anything else
+            if not stat.S_ISSOCK(os.stat(args.socket).st_mode):
+                raise Exception('[main()] ' + args.socket + ' exists and it is not a socket')
+
+            os.remove(args.socket)
+
+        server = ThreadingUnixServer(args.socket, RequestHandler)
+        address = args.socket
+    else:
+        server = ThreadingTCPServer((args.host, args.port), RequestHandler)
+        address = ':'.join([str(a) for a in server.server_address])
+
+    server.conversions = ConversionServer(args.workers, args.cache_entries, args.latency_window)
+    signal.signal(signal.SIGTERM, lambda signum, frame: exit(0))  # remove the socket file also when terminated
+    print ' '.join(["[i] Listening on", address, "with", str(args.workers), "workers"])
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+if __name__ == '__main__':
+    main()
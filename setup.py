@@ -11,7 +11,7 @@ setuptools.setup(
     author_email='f.asnicar@unitn.it',
     url='http://github.com/segatalab/export2graphlan',
     packages = setuptools.find_packages(),
-    scripts=['export2graphlan.py'],
+    scripts=['export2graphlan.py', 'export2graphlan_batch.py', 'export2graphlan_server.py'],
     package_dir = {'export2graphlan' : '' },
     long_description_content_type='text/markdown',
     long_description=open('README.md').read(),
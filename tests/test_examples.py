@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA = os.path.join(ROOT, 'tests', 'data')
+EXAMPLES = os.path.join(ROOT, 'examples')
+sys.path.insert(0, ROOT)
+import export2graphlan as e2g
+
+try:
+    import hclust2
+except ImportError:
+    hclust2 = None
+
+
+# the PIPELINE.sh conversions of the bundled examples: folder, lefse_input, lefse_output, options
+EXAMPLES_ARGV = [
+    ('hmp_aerobiosis', 'lefse_input.txt', 'lefse_output.txt',
+     ['--title', 'HMP Aerobiosis', '--annotations', '2,3', '--external_annotations', '4,5,6', '--fname_row', '0',
+      '--skip_rows', '1,2', '--ftop', '200']),
+    ('hmp_metahit_metabolic', 'merge.txt', 'merge.txt.out',
+     ['--title', 'Metabolic pathways', '--abundance_threshold', '50.0', '--external_annotations', '3',
+      '--background_clades', 'Metabolism.Metabolism_of_Cofactors_and_Vitamins, Metabolism.Carbohydrate_Metabolism, '
+      'Metabolism.Amino_Acid_Metabolism, Metabolism.Metabolism_of_Terpenoids_and_Polyketides, '
+      'Metabolism.Metabolism_of_Other_Amino_Acids, Genetic_Information_Processing.Replication_and_Repair, '
+      'Environmental_Information_Processing.Membrane_Transport',
+      '--background_colors', '(150.; 100.; 100.), (55.; 100.; 100.), (280.; 80.; 88.)', '--ftop', '125']),
+    ('hmp_metahit_mp2', 'merge-very-good.txt', 'merge-very-good.txt.out',
+     ['--title', 'MetaHIT vs. HMP (MetaPhlAn2)', '--max_clade_size', '250', '--min_clade_size', '40', '--annotations',
+      '5', '--external_annotations', '6,7', '--abundance_threshold', '40.5', '--fname_row', '0', '--ftop', '200',
+      '--annotation_legend_font_size', '11'])]
+
+
+@unittest.skipIf(hclust2 is None, 'hclust2 is not installed')
+class TestExamples(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_examples(self):
+        for name, lefse_input, lefse_output, options in EXAMPLES_ARGV:
+            tree = os.path.join(self.folder, name + '.tree')
+            annotation = os.path.join(self.folder, name + '.annot')
+            errors = e2g.run(e2g.read_params(['-i', os.path.join(EXAMPLES, name, lefse_input),
+                                              '-o', os.path.join(EXAMPLES, name, lefse_output),
+                                              '-t', tree, '-a', annotation] + options))
+            self.assertEqual(errors, [], msg=name)
+
+            for output in [tree, annotation]:
+                with open(output) as f, open(os.path.join(DATA, os.path.basename(output))) as g:
+                    self.assertEqual(f.read(), g.read(), msg=os.path.basename(output))
+
+    def test_background_levels_over_biomarkers(self):
+        # Firmicutes and Bacteroidetes are annotated biomarkers with descendants: the background of their level is
+        # written after their biomarker lines, so GraPhlAn (the last value wins) shows the background
+        name = 'hmp_metahit_mp2'
+        tree = os.path.join(self.folder, name + '.tree')
+        annotation = os.path.join(self.folder, name + '.annot')
+        errors = e2g.run(e2g.read_params(['-i', os.path.join(EXAMPLES, name, 'merge-very-good.txt'),
+                                          '-o', os.path.join(EXAMPLES, name, 'merge-very-good.txt.out'),
+                                          '-t', tree, '-a', annotation, '--annotations', '2,5',
+                                          '--external_annotations', '6,7', '--background_levels', '2',
+                                          '--abundance_threshold', '40.5', '--fname_row', '0', '--ftop', '200']))
+        self.assertEqual(errors, [])
+        resolved = {}
+
+        with open(annotation) as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+
+                if len(fields) == 3:
+                    resolved[(fields[0].split('.')[-1], fields[1])] = fields[2]
+
+        for clade in ['Firmicutes', 'Bacteroidetes']:
+            self.assertEqual(resolved[(clade, 'annotation_background_color')], '#2d19ff', msg=clade)
+            self.assertEqual(resolved[(clade, 'annotation')], 'Bacteria.' + clade, msg=clade)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+
+import os
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA = os.path.join(ROOT, 'tests', 'data')
+sys.path.insert(0, ROOT)
+import export2graphlan as e2g
+
+try:
+    import biom
+except ImportError:
+    biom = None
+
+
+def reference_merge(filename, keep_otus):
+    """
+    Merge the OTUs of the BIOM table sharing the same taxonomy one dense row at a time, the way the first version of
+    parse_biom() meant to, without its dropped first row and its one-column offset.
+    Return the dict of the average abundance of each merged feature.
+    """
+    table = biom.load_table(filename)
+    sums = {}
+
+    for values, otu, md in table.iter(axis='observation'):
+        taxa = '.'.join([l.split('__')[-1] for l in md['taxonomy']])
+
+        if keep_otus:
+            taxa += '.' + str(otu)
+
+        sums[taxa] = [s + v for s, v in zip(sums.get(taxa, [0.] * len(values)), values)]
+
+    return dict([(t, sum(s) / len(s)) for t, s in sums.iteritems()])
+
+
+@unittest.skipIf(biom is None, 'the biom-format package is not installed')
+class TestParseBiom(unittest.TestCase):
+    filename = os.path.join(DATA, 'duplicates.biom')
+
+    def assertAverages(self, averages, expected):
+        self.assertEqual(sorted(averages), sorted(expected))
+
+        for feat in expected:
+            self.assertAlmostEqual(averages[feat], expected[feat], msg=feat)
+
+    def test_merge_duplicate_taxa(self):
+        feats, averages = e2g.parse_biom(self.filename, keep_otus=False)
+
+        self.assertEqual(feats, ['Bacteria.Firmicutes.A', 'Bacteria.Bacteroidetes.B', 'Bacteria.Bacteroidetes.C'])
+        # OTU1 + OTU2 + OTU4 = [111, 202, 33], every column of every OTU summed
+        self.assertAverages(averages, {'Bacteria.Firmicutes.A': 346. / 3, 'Bacteria.Bacteroidetes.B': 5.,
+                                       'Bacteria.Bacteroidetes.C': 4.})
+
+    def test_keep_otus(self):
+        feats, averages = e2g.parse_biom(self.filename, keep_otus=True)
+
+        self.assertEqual(len(feats), 5)  # the first OTU is not dropped
+        self.assertAverages(averages, {'Bacteria.Firmicutes.A.OTU1': 2., 'Bacteria.Firmicutes.A.OTU2': 40. / 3,
+                                       'Bacteria.Bacteroidetes.B.OTU3': 5., 'Bacteria.Firmicutes.A.OTU4': 100.,
+                                       'Bacteria.Bacteroidetes.C.OTU5': 4.})
+
+    def test_internal_levels(self):
+        _, averages = e2g.parse_biom(self.filename, keep_otus=False, internal_levels=True)
+
+        self.assertAverages(averages, {'Bacteria': 373. / 3, 'Bacteria.Firmicutes': 346. / 3,
+                                       'Bacteria.Firmicutes.A': 346. / 3, 'Bacteria.Bacteroidetes': 9.,
+                                       'Bacteria.Bacteroidetes.B': 5., 'Bacteria.Bacteroidetes.C': 4.})
+
+    def test_reference_merge(self):
+        for keep_otus in [False, True]:
+            _, averages = e2g.parse_biom(self.filename, keep_otus=keep_otus)
+            self.assertAverages(averages, reference_merge(self.filename, keep_otus))
+
+
+if __name__ == '__main__':
+    unittest.main()
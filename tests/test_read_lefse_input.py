@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import export2graphlan as e2g
+
+try:
+    import hclust2
+except ImportError:
+    hclust2 = None
+
+
+# a lefse_input with a literal nan, a NaN, an NA and an empty value
+MATRIX = '\n'.join(['id\tS1\tS2\tS3',
+                    'k__Bacteria|p__Firmicutes\t1.0\tnan\t3.0',
+                    'k__Bacteria|p__Bacteroidetes\tNaN\t2.0\t4.0',
+                    'k__Bacteria|p__Proteobacteria\t5.0\tNA\t1.0',
+                    'k__Bacteria|p__Actinobacteria\t2.0\t\t2.0',
+                    'k__Bacteria|p__Fusobacteria\t0.5\t0.5\t0.5', ''])
+
+
+@unittest.skipIf(hclust2 is None, 'hclust2 is not installed')
+class TestStreamLefseInput(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filename = os.path.join(self.folder, 'lefse_input.txt')
+
+        with open(self.filename, 'w') as f:
+            f.write(MATRIX)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def assertSameAsDataMatrix(self, options):
+        args = e2g.read_params(['-i', self.filename, '-t', 'x.tree', '-a', 'x.annot', '--fname_row', '0'] + options)
+        fnames, averages = e2g.stream_lefse_input(args)
+        matrix = hclust2.DataMatrix(self.filename, args)
+        expected = dict(matrix.get_averages())
+
+        self.assertEqual(fnames, list(matrix.get_fnames()))
+
+        for feat in expected:
+            self.assertAlmostEqual(averages[feat], expected[feat], msg=feat)
+
+    def test_def_na(self):
+        self.assertSameAsDataMatrix(['--def_na', '0'])
+
+    def test_def_na_ftop(self):
+        self.assertSameAsDataMatrix(['--def_na', '0', '--ftop', '3'])
+
+    def test_literal_nan(self):
+        args = e2g.read_params(['-i', self.filename, '-t', 'x.tree', '-a', 'x.annot', '--fname_row', '0',
+                                '--def_na', '0'])
+        _, averages = e2g.stream_lefse_input(args)
+
+        self.assertAlmostEqual(averages['k__Bacteria|p__Firmicutes'], 4. / 3)
+
+    def test_default_params(self):
+        args = e2g.read_params(['-i', self.filename, '-t', 'x.tree', '-a', 'x.annot', '--fname_row', '0',
+                                '--def_na', '0'])
+        api_args = e2g.default_params(lefse_input=self.filename, fname_row=0, def_na=0.)
+
+        self.assertEqual(e2g.read_lefse_input(api_args), e2g.read_lefse_input(args))
+        self.assertRaises(Exception, e2g.default_params, lefse_input=self.filename, annotatons='2,3')
+
+
+if __name__ == '__main__':
+    unittest.main()